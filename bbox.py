@@ -98,8 +98,8 @@ def bbox_iou(box1, box2, lib = "torch"):
     
     #Intersection area
     if lib == "torch":
-        inter_area_w = max_measure(inter_rect_x2 - inter_rect_x1 + 1,torch.zeros(inter_rect_x2.shape).to(device))
-        inter_area_h = max_measure(inter_rect_y2 - inter_rect_y1 + 1, torch.zeros(inter_rect_x2.shape).to(device))
+        inter_area_w = max_measure(inter_rect_x2 - inter_rect_x1 + 1, torch.zeros_like(inter_rect_x2))
+        inter_area_h = max_measure(inter_rect_y2 - inter_rect_y1 + 1, torch.zeros_like(inter_rect_x2))
     else:
         inter_area_w = max_measure(inter_rect_x2 - inter_rect_x1 + 1,np.zeros(inter_rect_x2.shape))
         inter_area_h = max_measure(inter_rect_y2 - inter_rect_y1 + 1, np.zeros(inter_rect_x2.shape)) 
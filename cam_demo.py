@@ -6,12 +6,12 @@ from torch.autograd import Variable
 import numpy as np
 import cv2 
 from util import *
-from darknet import Darknet
 from preprocess import prep_image, inp_to_image
+from pipeline import frame_batches
+from resources import get_classes, get_palette, load_model
 import pandas as pd
 import random 
 import argparse
-import pickle as pkl
 
 def get_test_input(input_dim, CUDA):
     img = cv2.imread("imgs/messi.jpg")
@@ -41,8 +41,8 @@ def prep_image(img, inp_dim):
     return img_, orig_im, dim
 
 def write(x, img):
-    c1 = tuple(x[1:3].int())
-    c2 = tuple(x[3:5].int())
+    c1 = tuple(int(v) for v in x[1:3])
+    c2 = tuple(int(v) for v in x[3:5])
     cls = int(x[-1])
     label = "{0}".format(classes[cls])
     color = random.choice(colors)
@@ -66,6 +66,10 @@ def arg_parse():
     parser.add_argument("--reso", dest = 'reso', help = 
                         "Input resolution of the network. Increase to increase accuracy. Decrease to increase speed",
                         default = "160", type = str)
+    parser.add_argument("--bs", dest = "bs", help = "Most frames per forward",
+                        default = 1, type = int)
+    parser.add_argument("--batch_wait", dest = "batch_wait", help = "Milliseconds to wait for a batch to fill",
+                        default = 50, type = float)
     return parser.parse_args()
 
 
@@ -87,8 +91,7 @@ if __name__ == '__main__':
     num_classes = 80
     bbox_attrs = 5 + num_classes
     
-    model = Darknet(cfgfile)
-    model.load_weights(weightsfile)
+    model = load_model(cfgfile, weightsfile)
     
     model.net_info["height"] = args.reso
     inp_dim = int(model.net_info["height"])
@@ -101,6 +104,9 @@ if __name__ == '__main__':
             
     model.eval()
     
+    classes = get_classes('data/coco.names')
+    colors = get_palette()
+    
     videofile = 'video.avi'
     
     cap = cv2.VideoCapture(0)
@@ -109,57 +115,35 @@ if __name__ == '__main__':
     
     frames = 0
     start = time.time()    
-    while cap.isOpened():
+    stop = False
+    # frames are run through the network in batches of up to --bs frames
+    for batch in frame_batches(cap, args.bs, args.batch_wait/1000):
+        img = torch.cat([prep_image(frame, inp_dim)[0] for frame in batch])
         
-        ret, frame = cap.read()
-        if ret:
-            
-            img, orig_im, dim = prep_image(frame, inp_dim)
-            
-#            im_dim = torch.FloatTensor(dim).repeat(1,2)                        
-            
-            
-            if CUDA:
-                im_dim = im_dim.cuda()
-                img = img.cuda()
-            
-            
-            output = model(Variable(img), CUDA)
-            output = write_results(output, confidence, num_classes, nms = True, nms_conf = nms_thesh)
-
-            if type(output) == int:
-                frames += 1
-                print("FPS of the video is {:5.2f}".format( frames / (time.time() - start)))
-                cv2.imshow("frame", orig_im)
-                key = cv2.waitKey(1)
-                if key & 0xFF == ord('q'):
-                    break
-                continue
-            
-
+        if CUDA:
+            img = img.cuda()
         
-            output[:,1:5] = torch.clamp(output[:,1:5], 0.0, float(inp_dim))/inp_dim
-            
-#            im_dim = im_dim.repeat(output.size(0), 1)
-            output[:,[1,3]] *= frame.shape[1]
-            output[:,[2,4]] *= frame.shape[0]
-
-            
-            classes = load_classes('data/coco.names')
-            colors = pkl.load(open("pallete", "rb"))
-            
-            list(map(lambda x: write(x, orig_im), output))
-            
+        output = model(Variable(img))
+        output = write_results(output, confidence, num_classes, nms = True, nms_conf = nms_thesh)
+        
+        # back to one frame at a time, in capture order
+        for orig_im, detections in zip(batch, split_detections(output, len(batch))):
+            if detections is not None:
+                detections[:,1:5] = torch.clamp(detections[:,1:5], 0.0, float(inp_dim))/inp_dim
+                detections[:,[1,3]] *= orig_im.shape[1]
+                detections[:,[2,4]] *= orig_im.shape[0]
+                
+                list(map(lambda x: write(x, orig_im), detections))
             
             cv2.imshow("frame", orig_im)
             key = cv2.waitKey(1)
             if key & 0xFF == ord('q'):
+                stop = True
                 break
             frames += 1
             print("FPS of the video is {:5.2f}".format( frames / (time.time() - start)))
-
-            
-        else:
+        
+        if stop:
             break
     
 
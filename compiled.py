@@ -0,0 +1,140 @@
+"""
+Fast-load "compiled model" format for Darknet models.
+
+A compiled model holds everything needed to rebuild a Darknet without
+touching the cfg or the weights file: the parsed blocks, the compiled
+execution plan (resolved route/shortcut indices), the anchors of every
+yolo layer, the weights file header and one contiguous, aligned float32
+buffer with the weights in darknet file order.
+
+Layout
+------
+    magic (4 bytes) | version (uint32) | metadata length (uint64) |
+    metadata (utf-8 json) | padding to ALIGN | float32 weights
+
+Loading maps the file once and makes every parameter a view of the
+mapping, so nothing is parsed, initialised or copied. A loaded model
+saves back to the exact same darknet weights with `Darknet.save_weights`.
+
+e.g. python compiled.py --cfg cfg/yolov3.cfg --weights yolov3.weights --out yolov3.dkn
+
+"""
+
+import argparse
+import json
+import struct
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from darknet import Darknet
+
+MAGIC = b"DKNC"
+VERSION = 1
+ALIGN = 64
+PREAMBLE = struct.Struct("<4sIQ")
+
+
+def yolo_anchors(model):
+    """Anchors of every yolo layer, keyed by layer index"""
+    return {i: [list(a) for a in model.module_list[i][0].anchors]
+            for i, kind, _, _, _ in model.plan if kind == "yolo"}
+
+
+def save_compiled(model, savedfile):
+    """
+    Writes a Darknet model in the compiled format
+    """
+    header = model.header.clone()
+    header[3] = int(model.seen)
+
+    meta = {"blocks": model.blocks,
+            "plan": model.plan,
+            "anchors": yolo_anchors(model),
+            "header": [int(x) for x in header],
+            "num_weights": model.num_weights()}
+    meta = json.dumps(meta).encode("utf-8")
+
+    offset = PREAMBLE.size + len(meta)
+    padding = -offset % ALIGN
+
+    with open(savedfile, "wb") as fp:
+        fp.write(PREAMBLE.pack(MAGIC, VERSION, len(meta)))
+        fp.write(meta)
+        fp.write(b"\0"*padding)
+        for module, name in model.weight_layout():
+            getattr(module, name).detach().cpu().float().numpy().tofile(fp)
+
+
+def load_compiled(compiledfile, train=False):
+    """
+    Loads a model written by `save_compiled`. The file is mapped
+    copy-on-write once and every parameter is a view of the mapping
+    """
+    data = np.memmap(compiledfile, dtype = np.uint8, mode = "c")
+
+    magic, version, meta_len = PREAMBLE.unpack(bytes(data[:PREAMBLE.size]))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("{} is not a version {} compiled model".format(compiledfile, VERSION))
+
+    meta = json.loads(bytes(data[PREAMBLE.size:PREAMBLE.size + meta_len]).decode("utf-8"))
+
+    offset = PREAMBLE.size + meta_len
+    offset += -offset % ALIGN
+    weights = data[offset:offset + 4*meta["num_weights"]].view(np.float32)
+
+    #Build the layers without storage, the mapping provides it
+    plan = [tuple(step) for step in meta["plan"]]
+    model = Darknet(None, train=train, blocks=meta["blocks"], plan=plan, device="meta")
+
+    for i, anchors in meta["anchors"].items():
+        model.module_list[int(i)][0].anchors = [tuple(a) for a in anchors]
+
+    ptr = 0
+    for module, name in model.weight_layout():
+        tensor = getattr(module, name)
+        num = tensor.numel()
+        value = torch.from_numpy(weights[ptr:ptr + num]).view(tensor.shape)
+        ptr += num
+
+        if isinstance(tensor, nn.Parameter):
+            value = nn.Parameter(value, requires_grad=tensor.requires_grad)
+        setattr(module, name, value)
+
+    if ptr != weights.size:
+        raise ValueError("{} holds {} weights but its cfg expects {}".format(compiledfile, weights.size, ptr))
+
+    #Buffers that are not part of the darknet format
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.num_batches_tracked = torch.tensor(0, dtype=torch.long)
+
+    model.header = torch.IntTensor(meta["header"])
+    model.seen = model.header[3]
+
+    return model
+
+
+def arg_parse():
+    """
+    Parse arguements to the conversion module
+
+    """
+    parser = argparse.ArgumentParser(description='Convert a cfg and darknet weights to a compiled model')
+    parser.add_argument("--cfg", dest = 'cfgfile', help = "Config file",
+                        default = "cfg/yolov3.cfg", type = str)
+    parser.add_argument("--weights", dest = 'weightsfile', help = "weightsfile",
+                        default = "yolov3.weights", type = str)
+    parser.add_argument("--out", dest = 'out', help = "Compiled model to write",
+                        default = "yolov3.dkn", type = str)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+
+    model = Darknet(args.cfgfile, train=False)
+    model.load_weights(args.weightsfile, mmap=True)
+    save_compiled(model, args.out)
+    print("Wrote {}".format(args.out))
@@ -26,10 +26,10 @@ random.seed(0)
 
 def transform_annotation(x, image):
     """Convert the annotation/target boxes to a format understood by
-    dataset class"""
-    #convert the PIL image to a numpy array
+    dataset class. An image without annotations has no boxes"""
+    x = [a for a in x if a.strip()]
     if not x:
-        return None
+        return image, np.zeros((0, 5), dtype='float32')
     boxes = np.array([a.rstrip().split(' ') for a in x], dtype='float32')
     
     #get the bounding boxes and convert them into proper format
@@ -68,6 +68,9 @@ class CustomDataset(CocoDetection):
         self.num_pred_boxes = self.get_num_pred_boxes()
         
         self.box_strides = self.get_box_strides()
+        
+        #Anchor grid templates, per (inp_dim, strides, anchors)
+        self.templates = {}
         self.debug_id = None
 
     
@@ -86,7 +89,41 @@ class CustomDataset(CocoDetection):
     
     def set_inp_dim(self, inp_dim):
         self.inp_dim = inp_dim
+        self.num_pred_boxes = self.get_num_pred_boxes()
+        self.box_strides = self.get_box_strides()
+        
+    def template_key(self):
+        return (self.inp_dim, tuple(self.strides), tuple(self.anchor_nums), self.anchors.tobytes())
+    
+    def get_templates(self):
+        """
+        Centre, width and height of every anchor box of the current input
+        size, built once and shared by every sample
+        
+        Returns
+        -------
+        boxes : numpy array (2D), read only
+            [centre_x, centre_y, anchor_w, anchor_h, 0, 0] in pixels, what the
+            ground truth is matched against
+        
+        label_map : numpy array (2D), read only
+            The same in grid units ([cell_x, cell_y, anchor_w/stride, anchor_h/stride]),
+            the label maps of a batch start as copies of it (see `TargetBuilder`)
+        """
+        key = self.template_key()
+        
+        if key not in self.templates:
+            boxes = self.get_pred_box_cords(np.zeros((sum(self.num_pred_boxes), 6), dtype = np.float32))
+            
+            label_map = boxes.copy()
+            label_map[:,:2] //= self.box_strides 
+            label_map[:,[2,3]] /= self.box_strides
+            
+            boxes.setflags(write = False)
+            label_map.setflags(write = False)
+            self.templates[key] = boxes, label_map
         
+        return self.templates[key]
         
     def get_num_pred_boxes(self):    
         detection_map_dims = [(self.inp_dim//stride) for stride in self.strides]
@@ -98,7 +135,7 @@ class CustomDataset(CocoDetection):
         
         for n, pred_boxes in enumerate(self.num_pred_boxes):
             unit = self.strides[n]
-            corners = np.arange(0, inp_dim, unit)
+            corners = np.arange(0, self.inp_dim, unit)
             offset = unit // 2
             grid = np.meshgrid(corners, corners)
             
@@ -121,194 +158,131 @@ class CustomDataset(CocoDetection):
             j += self.anchor_nums[n]
         return label_map        
 
-    def get_ground_truth_predictors(self, ground_truth, label_map, im = None):
-        i = 0    #indexes the anchor boxes
-        j = 0    
-                
-        total_boxes_per_gt = sum(self.anchor_nums)
-        
-        num_ground_truth_in_im = ground_truth.shape[0]
+    def get_cell_anchors(self, ground_truth):
+        """
+        Label map indices of the anchors in the cell of every ground truth
+        box centre, on every scale, num_gt x sum(anchor_nums)
+        """
+        inds = []
+        for n, anchor_num in enumerate(self.anchor_nums):
+            offset = sum(self.num_pred_boxes[:n])
+            grid_size = self.inp_dim//self.strides[n]
+            
+            center_cells = np.clip(ground_truth[:,[0,1]]//self.strides[n], 0, grid_size - 1).astype(np.int64)
+            first = offset + anchor_num*(grid_size*center_cells[:,1] + center_cells[:,0])
+            inds.append(first[:,np.newaxis] + np.arange(anchor_num))
         
-
-        inds = np.zeros((num_ground_truth_in_im, total_boxes_per_gt), dtype = np.int)
-        
-        #n index the the detection maps
-        for n, anchor in enumerate(self.anchor_nums):
-            offset =  sum(self.num_pred_boxes[:n])
-            try:
-                center_cells = (ground_truth[:,[0,1]]) // self.strides[n]
-            except:
-                print(ground_truth)
-                assert False
+        return np.concatenate(inds, 1)
+    
+    def get_covered_anchors(self, ground_truth_boxes):
+        """
+        (ground truth, anchor) pairs of every anchor whose cell centre lies
+        in a ground truth box, on every scale
+        
+        Arguments
+        ---------
+        ground_truth_boxes : tensor (2D)
+            [x1, y1, x2, y2] in pixels
+        
+        Returns
+        -------
+        box_inds, anchor_inds : tensors (1D) of the same length
+        """
+        device = ground_truth_boxes.device
+        box_inds = []
+        anchor_inds = []
+        for n, anchor_num in enumerate(self.anchor_nums):
+            offset = sum(self.num_pred_boxes[:n])
+            stride = self.strides[n]
+            grid_size = self.inp_dim//stride
             
+            #First and last cell whose centre is in the box (with a pixel to spare)
+            low = torch.ceil((ground_truth_boxes[:,[0,1]] - 1 - stride//2)/stride).clamp(0, grid_size).long()
+            high = torch.floor((ground_truth_boxes[:,[2,3]] + 1 - stride//2)/stride).clamp(-1, grid_size - 1).long()
             
-            a = offset + self.anchor_nums[n]*(inp_dim//self.strides[n]*center_cells[:,1] + center_cells[:,0])
+            sizes = (high - low + 1).clamp(min = 0)
+            counts = sizes[:,0]*sizes[:,1]
             
-            inds[:,sum(self.anchor_nums[:n])] = a
+            #Enumerate the cells of every box row by row
+            box = torch.repeat_interleave(torch.arange(ground_truth_boxes.size(0), device = device), counts)
+            k = torch.arange(box.size(0), device = device) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+            width = sizes[box,0].clamp(min = 1)
+            cells_x = low[box,0] + k % width
+            cells_y = low[box,1] + k // width
             
-            for x in range(1, self.anchor_nums[n]):
-                inds[:,sum(self.anchor_nums[:n]) + x] = a + x 
-      
-    
-            i += anchor
-            j += self.num_pred_boxes[n]
-        
-        candidate_boxes = label_map[inds][:,:,:4]
-        
-
-        
-        
-    
-        
-        candidate_boxes = center_to_corner(candidate_boxes)
-        
-        
-                
-
+            first = offset + anchor_num*(grid_size*cells_y + cells_x)
+            box_inds.append(box.repeat_interleave(anchor_num))
+            anchor_inds.append((first.unsqueeze(1) + torch.arange(anchor_num, device = device)).view(-1))
         
+        return torch.cat(box_inds), torch.cat(anchor_inds)
     
+    def get_ground_truth_predictors(self, ground_truth, label_map, im = None):
+        """
+        Anchor predicting every ground truth box
+        
+        A box is matched against the anchors of its own cell on every scale.
+        Pairs are taken greedily by decreasing IoU and an anchor predicts at
+        most one box. A box whose anchors were all taken by others shares its
+        best one.
+        
+        Arguments
+        ---------
+        ground_truth : numpy array (2D)
+            [centre_x, centre_y, w, h, class] in pixels
+        
+        label_map : numpy array (2D)
+            Anchor boxes in pixels (see `get_templates`)
+        
+        Returns
+        -------
+        num_gt x 1 array of label map indices
+        """
+        inds = self.get_cell_anchors(ground_truth)
+        num_ground_truth_in_im, total_boxes_per_gt = inds.shape
+        rows = np.arange(num_ground_truth_in_im)
+        
+        candidate_boxes = center_to_corner(label_map[inds.ravel()][np.newaxis,:,:4]).squeeze(0)
         ground_truth_boxes = center_to_corner(ground_truth.copy()[np.newaxis]).squeeze(0)[:,:4]
+        ground_truth_boxes = ground_truth_boxes.repeat(total_boxes_per_gt, axis = 0)
         
-
-        candidate_boxes = candidate_boxes.transpose(0,2,1)
-        
-        ground_truth_boxes = ground_truth_boxes[:,:,np.newaxis]
-        
-        candidate_ious = bbox_iou(candidate_boxes, ground_truth_boxes, lib="numpy")
+        candidate_ious = bbox_iou(candidate_boxes, ground_truth_boxes, lib = "numpy").reshape(inds.shape)
         
+        #Boxes in the same cells compete for the same anchors
+        anchors, anchor_ids = np.unique(inds, return_inverse = True)
+        anchor_ids = anchor_ids.reshape(inds.shape)
+        box_ids = rows[:,np.newaxis].repeat(total_boxes_per_gt, axis = 1)
         
+        prediction_boxes = inds[rows, np.argmax(candidate_ious, 1)]
+        unassigned = np.ones(num_ground_truth_in_im, dtype = bool)
+        taken = np.zeros(anchors.shape[0], dtype = bool)
         
-        prediction_boxes = np.zeros((num_ground_truth_in_im,1), dtype=np.int)
-
-        for i in range(num_ground_truth_in_im):
-            #get the the row and the column of the highest IoU
-            max_iou_ind = np.argmax(candidate_ious)
-            max_iou_row = max_iou_ind // total_boxes_per_gt
-            max_iou_col = max_iou_ind % total_boxes_per_gt
-            
+        while True:
+            best = np.argmax(candidate_ious, 1)
+            best_iou = candidate_ious[rows, best]
+            best_anchor = anchor_ids[rows, best]
             
-            #get the index (in label map) of the box with maximum IoU
-            max_iou_box = inds[max_iou_row, max_iou_col]
+            #Highest IoU of every anchor and the first box reaching it
+            anchor_iou = np.full(anchors.shape[0], -1.0)
+            np.maximum.at(anchor_iou, anchor_ids.ravel(), candidate_ious.ravel())
+            hits = candidate_ious == anchor_iou[anchor_ids]
+            first_box = np.full(anchors.shape[0], num_ground_truth_in_im)
+            np.minimum.at(first_box, anchor_ids[hits], box_ids[hits])
             
-            #assign the bounding box to the appropriate gt
-            prediction_boxes[max_iou_row] = max_iou_box
+            #A pair that is the best of both its box and its anchor comes before
+            #every pair it competes with, so greedy takes it
+            won = unassigned & (best_iou >= 0) & (anchor_iou[best_anchor] == best_iou) & (first_box[best_anchor] == rows)
+            if not won.any():
+                break
             
-            #zero out all the IoUs for this box so it can't be reassigned to any other gt
-            box_mask = (inds != max_iou_ind).reshape(-1,len(self.anchors))
-            candidate_ious *= box_mask
-            
-            #zero out all the values of the row representing gt that just got assigned so that it 
-            #doesn't participate in the process again
-            candidate_ious[max_iou_row] *= 0
-        
-        return (prediction_boxes)
-    
-    def get_no_obj_candidates(self, ground_truth, label_map, ground_truth_predictors):
-                
-        total_boxes_per_gt = sum(self.anchor_nums)
-        
-        num_ground_truth_in_im = ground_truth.shape[0]
-        
-        
-        
-        inds = np.zeros((num_ground_truth_in_im, total_boxes_per_gt), dtype = np.int)
-        
-        inds = np.arange(sum(self.num_pred_boxes)).astype(int)
-        
-        inds = inds[np.newaxis].repeat(num_ground_truth_in_im, axis = 0)
-        
-        
-        candidate_boxes = label_map[inds][:,:,:4]
-        
-        candidate_boxes = center_to_corner(candidate_boxes)
-        
-        
-        
-    
-        ground_truth_boxes = center_to_corner(ground_truth.copy()[np.newaxis]).squeeze(0)[:,:4]
-        
-    
-        candidate_boxes = candidate_boxes.transpose(0,2,1)
-        
-        ground_truth_boxes = ground_truth_boxes[:,:,np.newaxis]
-        
-        candidate_ious = bbox_iou(candidate_boxes, ground_truth_boxes, lib = "numpy")
-        
-        candidate_ious[:, ground_truth_predictors] = 1
-        
-        
-        max_ious_per_box = np.max(candidate_ious, 0)
-        
-        no_obj_cands = (np.nonzero(max_ious_per_box < 0.5)[0].astype(int))
-        
-        return no_obj_cands
-        
-        
-    def get_ground_truth_map(self, ground_truth, label_map, ground_truth_predictors, no_obj_cands):
-    
-        #Set the objectness confidence of these boxes to 1
-        
-        label_map[:,4] = -1
-        
-        predboxes = label_map[ground_truth_predictors]
-        
-        predboxes[:,4] = 1
-        
-        label_map[no_obj_cands] = 0
-        
-        assert ground_truth_predictors.shape[0] == predboxes.shape[0], print(self.debug_id)
-        
-
-        
-        
-        ground_truth_strides = self.box_strides[ground_truth_predictors]
-        ground_truth[:,:4] /= ground_truth_strides
-        
-        
-
-
-        try:
-            predboxes[:,[0,1]] = ground_truth[:,[0,1]] - predboxes[:,[0,1]]
-        
-        except:
-            print(self.debug_id)
-            assert False
-
-        
-        if 0 in predboxes[:,[0,1]]:
-            predboxes[:,[0,1]] += 0.0001*(predboxes[:,[0,1]] == 0)
-
-
-
-        predboxes[:,[0,1]] = -1*np.log(1/(predboxes[:,[0,1]]) - 1)
-        
-        mask = np.logical_and(ground_truth[:,2], ground_truth[:,3])
-        
+            prediction_boxes[won] = inds[won, best[won]]
+            unassigned[won] = False
+            taken[best_anchor[won]] = True
             
-        mask= mask.reshape(-1,1)
-        
-        ground_truth *= mask 
-        
-        nz_inds = np.nonzero(ground_truth[:,0])
-        ground_truth = ground_truth[nz_inds]
-        predboxes = predboxes[nz_inds]
-        ground_truth_predictors = ground_truth_predictors[nz_inds]
-        
-        try:
-            predboxes[:,[2,3]] = np.log(ground_truth[:,[2,3]] / predboxes[:,[2,3]])
-        
-        except:
-            print(self.debug_id)
-            assert False
+            #Neither these boxes nor their anchors take part any more
+            candidate_ious[won] = -1
+            candidate_ious[taken[anchor_ids]] = -1
         
-        predboxes[:,5] = ground_truth[:,4]
-        
-        label_map[ground_truth_predictors] = predboxes
-        
-        return label_map
-    
-
-    
+        return prediction_boxes.reshape(-1,1)
     
     def __getitem__(self, idx):
         example = self.examples[idx]
@@ -316,25 +290,24 @@ class CustomDataset(CocoDetection):
         path = os.path.join(os.getcwd(), example).rstrip()
         image = cv2.imread(path)[:,:,::-1]   #Load the image from opencv and convert to RGB
 
-        label_table = np.zeros((sum(self.num_pred_boxes), 6), dtype = np.float)
-        label_table = self.get_pred_box_cords(label_table)
+        anchor_boxes, _ = self.get_templates()
                 
         #seperate images, boxes and class_ids
-        ground_truth = None
-        with open(example.replace(example.split('.')[-1], 'txt')) as f:
-            ground_truth = transform_annotation(f.readlines(), image)
-
-        if ground_truth is None:
-            #Convert the cv2 image into a PyTorch 
-            image = image.transpose(2,0,1)/255.0
-            image = torch.Tensor(image)
-            ground_truth_map = torch.Tensor(label_table)
-            return image, []
+        #An image without a label file, or with an empty one, is a negative:
+        #it goes through the same transforms and trains as all background
+        label_file = example.replace(example.split('.')[-1], 'txt')
+        annotation = []
+        if os.path.exists(label_file):
+            with open(label_file) as f:
+                annotation = f.readlines()
+        ground_truth = transform_annotation(annotation, image)
 
         self.debug_id = example
         #apply the augmentations to the image and the bounding boxes
         if self.det_transforms:
             image, ground_truth = self.det_transforms(image, ground_truth)
+        else:
+            image, ground_truth = ground_truth
     
         im = image.copy()
 
@@ -344,26 +317,175 @@ class CustomDataset(CocoDetection):
             
         #  ground_truth = corner_to_center(ground_truth[np.newaxis,:,:]).squeeze().reshape(-1,5)
             
+        #The ground truth stays sparse, one row per box. The label maps are
+        #built for the whole batch on the training device (see `TargetBuilder`)
         if ground_truth.shape[0] > 0:
             ground_truth = ground_truth[np.newaxis,:,:].squeeze().reshape(-1,5)
-            #Generate a table of labels
             #Get the bounding boxes to be assigned to the ground truth
-            ground_truth_predictors = self.get_ground_truth_predictors(ground_truth, label_table)
-            
-            no_obj_cands = self.get_no_obj_candidates(ground_truth, label_table, ground_truth_predictors)
+            ground_truth_predictors = self.get_ground_truth_predictors(ground_truth, anchor_boxes)
+            ground_truth = np.concatenate([ground_truth, ground_truth_predictors], 1)
+        else:
+            ground_truth = np.zeros((0, 6))
 
-            ground_truth_predictors = ground_truth_predictors.squeeze(1)
+        return image, torch.Tensor(ground_truth)
 
-            label_table[:,:2] //= self.box_strides 
-            label_table[:,[2,3]] /= self.box_strides
 
-            ground_truth_map = self.get_ground_truth_map(ground_truth, label_table, ground_truth_predictors, no_obj_cands)
+def sparse_collate(batch):
+    """
+    Stacks the images of a batch and puts the ground truth boxes of all of
+    them in one table
+    
+    Returns
+    -------
+    images : tensor (4D)
+    
+    ground_truth : tensor (2D)
+        [batch_index, centre_x, centre_y, w, h, class, anchor], see `TargetBuilder`.
+        Images have any number of boxes, none for a negative, so a batch
+        may have no rows at all
+    """
+    images = torch.stack([image for image, _ in batch])
+    
+    ground_truth = torch.cat([torch.cat([gt.new_full((gt.size(0), 1), i), gt], 1)
+                              for i, (_, gt) in enumerate(batch)])
+    return images, ground_truth
+
+
+def seed_worker(worker_id):
+    """
+    Seeds random and numpy (what data_aug draws from) in a loader worker
+    from the worker's torch seed, which follows the loader's generator
+    """
+    seed = torch.initial_seed() % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def training_loader(dataset, batch_size, num_workers = 0, persistent_workers = False, prefetch_factor = 2,
+                    pin_memory = False, shuffle = False, seed = 0):
+    """
+    DataLoader over a CustomDataset, batches of (images, sparse ground truth)
+    from `sparse_collate`
+    
+    Worker randomness is seeded from seed, so the augmentations of a run are
+    reproducible for the same seed and number of workers
+    """
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    
+    options = {}
+    if num_workers > 0:
+        #Only meaningful with worker processes, DataLoader rejects them otherwise
+        options = {"persistent_workers": persistent_workers, "prefetch_factor": prefetch_factor}
+    
+    return DataLoader(dataset, batch_size, shuffle = shuffle, collate_fn = sparse_collate,
+                      num_workers = num_workers, pin_memory = pin_memory, worker_init_fn = seed_worker,
+                      generator = generator, **options)
 
-            ground_truth_map = torch.Tensor(ground_truth_map)
-        else:
-            ground_truth_map = torch.Tensor(label_table)
 
-        return image, ground_truth_map
+class TargetBuilder(object):
+    """
+    Dense label maps of a batch, built from the sparse ground truth of
+    `CustomDataset` on the device the ground truth is on
+    
+    Every anchor of the label map of an image gets one row
+    
+        [t_x, t_y, t_w, t_h, 1, class]           the anchor predicting a box
+        [cell_x, cell_y, anchor_w, anchor_h, -1, 0]   an anchor overlapping a box
+                                                 (IoU >= 0.5) without predicting it
+        0                                        every other anchor (background)
+    
+    t_x, t_y are the logits of the box centre in its cell and t_w, t_h the log
+    of the box size over the anchor size
+    
+    e.g.
+        targets = TargetBuilder(dataset)
+        for images, ground_truth in DataLoader(dataset, bs, collate_fn = sparse_collate):
+            label_maps = targets(ground_truth.to(device), images.size(0))
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        #Templates of the dataset per device, kept out of the dataset so the
+        #loader workers never get device tensors
+        self.templates = {}
+    
+    def get_templates(self, device):
+        """Anchor boxes, label map and box strides of the dataset as tensors on device"""
+        key = self.dataset.template_key() + (str(device),)
+        if key not in self.templates:
+            boxes, label_map = self.dataset.get_templates()
+            self.templates[key] = (torch.tensor(boxes, device = device),
+                                   torch.tensor(label_map, device = device),
+                                   torch.tensor(self.dataset.box_strides, dtype = torch.float32, device = device))
+        return self.templates[key]
+    
+    def get_background(self, ground_truth, batch_size):
+        """
+        Background anchors: they predict no box and overlap none with an IoU
+        of 0.5 or more, batch_size x num_anchors (bool)
+        
+        An anchor whose centre lies outside a box has less than half of its
+        area in the box, so only the anchors of the cells each box covers
+        are compared with it.
+        """
+        anchor_boxes, _, _ = self.get_templates(ground_truth.device)
+        num_anchors = anchor_boxes.size(0)
+        
+        batch_inds = ground_truth[:,0].long()
+        ground_truth_boxes = center_to_corner(ground_truth[:,1:5].clone().unsqueeze(0)).squeeze(0)
+        box_inds, anchor_inds = self.dataset.get_covered_anchors(ground_truth_boxes)
+        
+        candidate_boxes = center_to_corner(anchor_boxes[anchor_inds,:4].unsqueeze(0)).squeeze(0)
+        candidate_ious = bbox_iou(candidate_boxes, ground_truth_boxes[box_inds])
+        
+        ignore = torch.zeros(batch_size*num_anchors, dtype = torch.bool, device = ground_truth.device)
+        ignore[(batch_inds[box_inds]*num_anchors + anchor_inds)[candidate_ious >= 0.5]] = True
+        ignore[batch_inds*num_anchors + ground_truth[:,6].long()] = True
+        
+        return ~ignore.view(batch_size, num_anchors)
+    
+    def __call__(self, ground_truth, batch_size):
+        """
+        Label maps of a batch
+        
+        Arguments
+        ---------
+        ground_truth : tensor (2D)
+            [batch_index, centre_x, centre_y, w, h, class, anchor] in pixels
+            (see `sparse_collate`)
+        
+        Returns
+        -------
+        label_maps : tensor (3D)
+            batch_size x num_anchors x 6
+        """
+        _, label_map, box_strides = self.get_templates(ground_truth.device)
+        num_anchors = label_map.size(0)
+        
+        label_maps = label_map.repeat(batch_size, 1, 1)
+        label_maps[:,:,4] = -1
+        label_maps[self.get_background(ground_truth, batch_size)] = 0
+        
+        predictors = ground_truth[:,6].long()
+        strides = box_strides[predictors]
+        predboxes = label_map[predictors].clone()
+        predboxes[:,4] = 1
+        
+        #Centre in the cell as a logit, a centre on the cell border is nudged in
+        centres = ground_truth[:,[1,2]]/strides - predboxes[:,[0,1]]
+        centres += 0.0001*(centres == 0)
+        predboxes[:,[0,1]] = -1*torch.log(1/centres - 1)
+        
+        #Boxes without an area (or at x = 0) get no targets
+        keep = (ground_truth[:,1] != 0) & (ground_truth[:,3] != 0) & (ground_truth[:,4] != 0)
+        
+        predboxes[:,[2,3]] = torch.log(ground_truth[:,[3,4]]/strides / predboxes[:,[2,3]])
+        predboxes[:,5] = ground_truth[:,5]
+        
+        rows = ground_truth[:,0].long()*num_anchors + predictors
+        label_maps.view(-1, 6)[rows[keep]] = predboxes[keep]
+        
+        return label_maps
                  
 ##        
 #####    
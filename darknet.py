@@ -7,9 +7,11 @@ from torch.autograd import Variable
 import numpy as np
 import cv2 
 import matplotlib.pyplot as plt
+from collections import OrderedDict
 from util import count_parameters as count
 from util import convert2cpu as cpu
-from util import predict_transform
+from util import predict_transform, predict_transform_sparse, make_offsets
+from tta import detect_tta
 
 
 class test_net(nn.Module):
@@ -87,11 +89,30 @@ class DetectionLayer(nn.Module):
     def __init__(self, anchors):
         super(DetectionLayer, self).__init__()
         self.anchors = anchors
+        self.offsets = {}
     
-    def forward(self, x, inp_dim, num_classes, confidence):
-        x = x.data
-        prediction = x
-        prediction = predict_transform(prediction, inp_dim, self.anchors, num_classes, confidence)
+    def get_offsets(self, grid_size, stride, device, dtype):
+        """
+        Grid and anchor offsets for this head, cached per 
+        (grid_size, stride, anchors, device, dtype). Only one input resolution
+        is kept, a new grid size evicts the entries of the previous one
+        """
+        key = (grid_size, stride, tuple(tuple(a) for a in self.anchors), device, dtype)
+        if key not in self.offsets:
+            if any(k[:2] != key[:2] for k in self.offsets):
+                self.offsets.clear()
+            self.offsets[key] = make_offsets(grid_size, stride, self.anchors, device, dtype)
+        return self.offsets[key]
+    
+    def forward(self, x, inp_dim, num_classes, train=False, out=None, confidence=None):
+        stride = inp_dim // x.size(2)
+        grid_size = inp_dim // stride
+        offsets = None
+        if not train:
+            offsets = self.get_offsets(grid_size, stride, x.device, x.dtype)
+        if confidence is not None and not train:
+            return predict_transform_sparse(x, inp_dim, self.anchors, num_classes, confidence, offsets=offsets)
+        prediction = predict_transform(x, inp_dim, self.anchors, num_classes, train=train, offsets=offsets, out=out)
         return prediction
 
 class Upsample(nn.Module):
@@ -132,7 +153,12 @@ class ReOrgLayer(nn.Module):
         return x
 
 
-def create_modules(blocks):
+def create_modules(blocks, device=None):
+    """
+    Builds the PyTorch modules for the cfg blocks. With device="meta" the 
+    layers get no storage and no initialisation, for loaders that assign
+    every parameter themselves
+    """
     net_info = blocks[0]     #Captures the information about the input and pre-processing
     print(net_info)  
     
@@ -173,12 +199,13 @@ def create_modules(blocks):
                 pad = 0
                 
             #Add the convolutional layer
-            conv = nn.Conv2d(prev_filters, filters, kernel_size, stride, pad, bias = bias)
+            factory = {} if device is None else {"device": device}
+            conv = nn.Conv2d(prev_filters, filters, kernel_size, stride, pad, bias = bias, **factory)
             module.add_module("conv_{0}".format(index), conv)
             
             #Add the Batch Norm Layer
             if batch_normalize:
-                bn = nn.BatchNorm2d(filters)
+                bn = nn.BatchNorm2d(filters, **factory)
                 module.add_module("batch_norm_{0}".format(index), bn)
             
             #Check the activation. 
@@ -200,14 +227,14 @@ def create_modules(blocks):
         
         #If it is a route layer
         elif (x["type"] == "route"):
-            x["layers"] = x["layers"].split(',')
+            layers = x["layers"].split(',')
             
             #Start  of a route
-            start = int(x["layers"][0])
+            start = int(layers[0])
             
             #end, if there exists one.
             try:
-                end = int(x["layers"][1])
+                end = int(layers[1])
             except:
                 end = 0
                 
@@ -281,15 +308,241 @@ def create_modules(blocks):
     return (net_info, module_list)
 
 
+def route_layers(block, index):
+    """
+    Absolute indices of the layers read by a route or shortcut block at `index`
+    """
+    if block["type"] == "shortcut":
+        return [index - 1, index + int(block["from"])]
+    
+    layers = [int(a) for a in block["layers"].split(',')]
+    
+    #Positive anotation is absolute, negative is relative to the route
+    return [a if a > 0 else index + a for a in layers]
+
+
+def output_liveness(blocks):
+    """
+    Works out which layer outputs have to be kept around for later route and
+    shortcut layers and for how long
+    
+    Returns
+    -------
+    inputs : list
+        for every layer, the absolute indices of the outputs it reads 
+        explicitly (only route and shortcut layers do)
+    
+    last_use : dict
+        for every output read explicitly, the index of its last reader
+    """
+    inputs = []
+    for i, block in enumerate(blocks[1:]):
+        if block["type"] in ("route", "shortcut"):
+            inputs.append(route_layers(block, i))
+        else:
+            inputs.append([])
+    
+    last_use = {}
+    for i, layers in enumerate(inputs):
+        for j in layers:
+            last_use[j] = i
+    
+    return inputs, last_use
+
+
+def compile_plan(blocks):
+    """
+    Resolves the cfg blocks into a flat execution plan so that forward does not
+    have to re-interpret them on every call
+    
+    Returns a list with one tuple per layer (the net block excluded)
+    
+        (index, kind, inputs, save, free)
+    
+    kind is "module", "route", "shortcut" or "yolo", inputs are the absolute 
+    indices a route/shortcut reads, save tells whether a later route/shortcut 
+    reads this layer's output and free lists the saved outputs whose last 
+    reader is this layer
+    """
+    modules = blocks[1:]
+    inputs, last_use = output_liveness(blocks)
+    
+    free = [[] for _ in modules]
+    for j, i in last_use.items():
+        free[i].append(j)
+    
+    plan = []
+    for i, block in enumerate(modules):
+        kind = block["type"]
+        if kind not in ("route", "shortcut", "yolo"):
+            kind = "module"
+        plan.append((i, kind, inputs[i], i in last_use, sorted(free[i])))
+    
+    return plan
+
+
+def prune_plan(plan, heads):
+    """
+    Cuts a plan (see `compile_plan`) down to the layers the yolo layers in
+    heads depend on, so that heads nobody asked for and the layers that
+    only feed them are never computed. save/free are worked out again for
+    the remaining layers
+    """
+    heads = set(heads)
+    needed = set(heads)
+    for i, kind, inputs, _, _ in reversed(plan):
+        if i not in needed:
+            continue
+        if kind in ("route", "shortcut"):
+            needed.update(inputs)
+        elif i > 0:
+            needed.add(i - 1)
+    
+    #A yolo layer passes its input through, skipping the unused ones is safe
+    steps = [step for step in plan if step[0] in needed and (step[1] != "yolo" or step[0] in heads)]
+    
+    last_use = {}
+    for i, kind, inputs, _, _ in steps:
+        for j in inputs:
+            last_use[j] = i
+    
+    free = {}
+    for j, i in last_use.items():
+        free.setdefault(i, []).append(j)
+    
+    return [(i, kind, inputs, i in last_use, sorted(free.get(i, [])))
+            for i, kind, inputs, _, _ in steps]
+
+
+def layer_shapes(blocks, inp_dim):
+    """
+    Output shape (channels, height, width) of every layer for a square input 
+    of size inp_dim, worked out from the cfg alone
+    
+    Returns the list of shapes and, for the yolo layers, the number of 
+    elements in the decoded detections (per image)
+    """
+    shapes = []
+    det_sizes = {}
+    c, h, w = int(blocks[0].get("channels", 3)), inp_dim, inp_dim
+    inputs, _ = output_liveness(blocks)
+    
+    for i, block in enumerate(blocks[1:]):
+        kind = block["type"]
+        if kind == "convolutional":
+            size = int(block["size"])
+            stride = int(block["stride"])
+            pad = (size - 1) // 2 if int(block["pad"]) else 0
+            c = int(block["filters"])
+            h = (h + 2*pad - size) // stride + 1
+            w = (w + 2*pad - size) // stride + 1
+        
+        elif kind == "upsample":
+            stride = int(block["stride"])
+            h, w = h*stride, w*stride
+        
+        elif kind == "maxpool":
+            size = int(block["size"])
+            stride = int(block["stride"])
+            if stride == 1:
+                #MaxPoolStride1 pads by size - 1 and pools with that stride
+                pad = size - 1
+                h = (h + pad - size) // pad + 1
+                w = (w + pad - size) // pad + 1
+            else:
+                h = (h - size) // stride + 1
+                w = (w - size) // stride + 1
+        
+        elif kind == "route":
+            c = sum(shapes[j][0] for j in inputs[i])
+            h, w = shapes[inputs[i][0]][1:]
+        
+        elif kind == "yolo":
+            num_anchors = len(block["mask"].split(","))
+            det_sizes[i] = h*w*num_anchors*(5 + int(block["classes"]))
+        
+        shapes.append((c, h, w))
+    
+    return shapes, det_sizes
+
+
+def activation_memory(blocks, inp_dim, batch_size=1, bytes_per_element=4):
+    """
+    Estimates the activation memory of one inference forward pass
+    
+    Every tensor the plan from `compile_plan` keeps alive is counted at each
+    layer: the saved route/shortcut outputs, the current input and output and
+    the decoded detections. Temporaries inside a layer are not counted
+    
+    Returns
+    -------
+    peak : int
+        peak activation bytes with outputs freed after their last reader
+    
+    keep_all : int
+        activation bytes when every layer output is kept to the end of the pass
+    
+    live : list
+        bytes alive at every layer, plus a last entry for the final torch.cat 
+        of the detections
+    """
+    shapes, det_sizes = layer_shapes(blocks, inp_dim)
+    scale = batch_size*bytes_per_element
+    
+    #tensors are identified by the layer that allocates them
+    tensors = {"input": int(blocks[0].get("channels", 3))*inp_dim*inp_dim*scale}
+    x = "input"
+    saved = {}
+    dets = []
+    live = []
+    
+    for i, kind, inputs, save, free in compile_plan(blocks):
+        if kind == "route" and len(inputs) == 1:
+            out = saved[inputs[0]]
+        elif kind == "yolo":
+            out = x
+            tensors[("det", i)] = det_sizes[i]*scale
+            dets.append(("det", i))
+        else:
+            c, h, w = shapes[i]
+            tensors[i] = c*h*w*scale
+            out = i
+        
+        alive = set(saved.values()) | set(dets) | {x, out}
+        live.append(sum(tensors[t] for t in alive))
+        
+        x = out
+        if save:
+            saved[i] = x
+        for j in free:
+            del saved[j]
+    
+    det_bytes = sum(tensors[t] for t in dets)
+    live.append(tensors[x] + 2*det_bytes)
+    
+    #without liveness every output stays in `outputs` until the pass ends
+    keep_all = sum(tensors.values()) + det_bytes
+    
+    return max(live), keep_all, live
+
 
 class Darknet(nn.Module):
-    def __init__(self, cfgfile, train=True):
+    def __init__(self, cfgfile, train=True, blocks=None, plan=None, device=None):
+        """
+        Builds the network from cfgfile, or from already parsed blocks (and 
+        their compiled plan) when given, see compiled.py
+        """
         super(Darknet, self).__init__()
-        self.blocks = parse_cfg(cfgfile)
-        self.net_info, self.module_list = create_modules(self.blocks)
-        self.header = torch.IntTensor([0,0,0,0])
+        self.blocks = parse_cfg(cfgfile) if blocks is None else blocks
+        self.net_info, self.module_list = create_modules(self.blocks, device)
+        self.plan = compile_plan(self.blocks) if plan is None else plan
+        self.num_classes = self.get_num_classes()
+        self.header = torch.IntTensor([0,0,0,0,0])
         self.seen = 0
         self.training = train
+        self.fused = False
+        self.head_slices = {}
+        self.head_plans = {}
 
     def get_blocks(self):
         return self.blocks
@@ -297,118 +550,252 @@ class Darknet(nn.Module):
     def get_module_list(self):
         return self.module_list
     
-    
-    def get_scale_inds(self, scales, inp_dim):
-        det_scales = []
-        num_anchors = 0
-        stride = 1
-        
+    def get_num_classes(self):
+        """Number of classes from the net block, or from the yolo blocks if 
+        the net block does not have it"""
+        if "classes" in self.net_info:
+            return int(self.net_info["classes"])
         for x in self.blocks:
-            try:
-                x["stride"]
-                if x["type"] == "upsample":
-                    stride //= int(x["stride"])
-                else:
-                    stride *= int(x["stride"])
-            except KeyError:
-                pass
-            
             if x["type"] == "yolo":
-                det_scales.append(stride)
-                num_anchors = (len(x["anchors"].split()))
-        
+                return int(x["classes"])
+        return 0
+    
+    
+    def fuse(self):
+        """
+        Folds every batch norm layer into the convolution before it and puts
+        the model in evaluation mode. This is an inference only transform,
+        save_weights still writes darknet weights for the original cfg
+        """
+        if self.fused:
+            return self
         
-        num_anchors //= len(det_scales)
+        for i in range(len(self.module_list)):
+            model = self.module_list[i]
+            if self.blocks[i + 1]["type"] != "convolutional" or len(model) < 2 \
+               or not isinstance(model[1], nn.BatchNorm2d):
+                continue
+            
+            conv, bn = model[0], model[1]
+            self.fuse_eps = bn.eps
+            
+            #BN(conv(x)) = scale*conv(x) + (bias - scale*mean)
+            scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+            conv.weight.data *= scale.view(-1, 1, 1, 1)
+            conv.bias = nn.Parameter(bn.bias.data - scale*bn.running_mean)
+            
+            layers = [(name, layer) for name, layer in model.named_children() if layer is not bn]
+            self.module_list[i] = nn.Sequential(OrderedDict(layers))
         
-        scale_factors = [inp_dim//x for x in det_scales]
+        self.fused = True
+        return self.eval()
+    
+    def yolo_layers(self):
+        """Layer indices of the yolo layers, in cfg order"""
+        return [i for i, kind, _, _, _ in self.plan if kind == "yolo"]
+    
+    def get_plan(self, heads=None):
+        """
+        Execution plan computing only the yolo layers numbered heads (from 1,
+        in cfg order), all of them for None, see `prune_plan`
+        """
+        if heads is None:
+            return self.plan
         
-        num_boxes_per_scale = [x*x*num_anchors for x in scale_factors]
+        heads = tuple(sorted(set(heads)))
+        if heads not in self.head_plans:
+            yolo = self.yolo_layers()
+            if not heads or heads[0] < 1 or heads[-1] > len(yolo):
+                raise ValueError("Heads {} out of range, the network has {} yolo layers".format(list(heads), len(yolo)))
+            self.head_plans[heads] = prune_plan(self.plan, [yolo[h - 1] for h in heads])
+        return self.head_plans[heads]
+    
+    def get_head_slices(self, inp_dim, heads=None):
+        """
+        Where every (selected) yolo layer writes in the detections tensor at
+        inp_dim, the selected heads are packed one after the other
         
-        i = 0
+        Returns a dict {layer index: (start, end)} over the box dimension and
+        the total number of boxes, cached for one inp_dim at a time
+        """
+        key = (inp_dim, None if heads is None else tuple(sorted(set(heads))))
+        if key not in self.head_slices:
+            if any(cached != inp_dim for cached, _ in self.head_slices):
+                self.head_slices = {}
+            shapes, _ = layer_shapes(self.blocks, inp_dim)
+            slices = {}
+            start = 0
+            for i, kind, _, _, _ in self.get_plan(heads):
+                if kind == "yolo":
+                    _, h, w = shapes[i]
+                    end = start + h*w*len(self.module_list[i][0].anchors)
+                    slices[i] = (start, end)
+                    start = end
+            self.head_slices[key] = (slices, start)
+        return self.head_slices[key]
+    
+    def activation_memory(self, inp_dim=None, batch_size=1):
+        """
+        Peak activation bytes of an inference pass at inp_dim (the cfg height
+        by default), see `activation_memory`
+        """
+        if inp_dim is None:
+            inp_dim = int(self.net_info["height"])
+        bytes_per_element = next(self.parameters()).element_size()
+        return activation_memory(self.blocks, inp_dim, batch_size, bytes_per_element)[0]
+    
+    def get_scale_inds(self, scales, inp_dim):
+        """
+        Box indices of the detections of the yolo layers numbered scales 
+        (from 1), prefer `forward(x, heads=scales)` which does not compute
+        the other heads at all
+        """
+        slices, _ = self.get_head_slices(inp_dim)
         scale_inds = []
-        for scale, num in enumerate(num_boxes_per_scale):
-            inds = list(range(i,i+num))
+        for scale, i in enumerate(self.yolo_layers()):
             if scale + 1 in scales:
-                scale_inds.extend(inds)
-            i = num
-
+                scale_inds.extend(range(*slices[i]))
         return scale_inds
          
-    def forward(self, x):
-        detections = []
-        modules = self.blocks[1:]
-        outputs = {}   #We cache the outputs for the route layer
+    def forward(self, x, *, confidence=None, heads=None):
+        """
+        Returns the detections of all yolo layers, batch x boxes x bbox_attrs.
+        
+        heads picks the yolo layers to compute (numbered from 1 in cfg 
+        order), the layers only the other ones need are skipped and the
+        detections of the selected heads follow each other in cfg order.
+        
+        With confidence (inference only), every yolo layer drops the anchors 
+        whose objectness is not above it before decoding and the result is a
+        compact list, one row per surviving anchor:
+        [batch_index, centre_x, centre_y, box_width, box_height, objectness, class_confidence...]
+        """
+        outputs = {}   #We cache the outputs read by later route/shortcut layers
         
+        #Get the input dimensions
+        inp_dim = x.size(2)
         
-        write = 0
-        for i in range(len(modules)):       
-            module_type = (modules[i]["type"])
-            if module_type == "convolutional" or module_type == "upsample" or module_type == "maxpool":
+        sparse = confidence is not None and not self.training
+        
+        #In inference every yolo layer decodes straight into its slice of 
+        #one detections tensor, training concatenates the raw outputs
+        if self.training or sparse:
+            detections = []
+        else:
+            slices, num_boxes = self.get_head_slices(inp_dim, heads)
+            if not slices:
+                return 0
+            detections = x.new_empty(x.size(0), num_boxes, 5 + self.num_classes)
+        
+        for i, kind, inputs, save, free in self.get_plan(heads):
+            if kind == "module":
                 x = self.module_list[i](x)
-                outputs[i] = x
-
-                
-            elif module_type == "route":
-                layers = modules[i]["layers"]
-                layers = [int(a) for a in layers]
-                
-                if (layers[0]) > 0:
-                    layers[0] = layers[0] - i
-
-                if len(layers) == 1:
-                    x = outputs[i + (layers[0])]
-
+            
+            elif kind == "route":
+                if len(inputs) == 1:
+                    x = outputs[inputs[0]]
                 else:
-                    if (layers[1]) > 0:
-                        layers[1] = layers[1] - i
-                        
-                    map1 = outputs[i + layers[0]]
-                    map2 = outputs[i + layers[1]]
-                    
-                    
-                    x = torch.cat((map1, map2), 1)
-                outputs[i] = x
+                    x = torch.cat([outputs[j] for j in inputs], 1)
             
-            elif  module_type == "shortcut":
-                from_ = int(modules[i]["from"])
-                x = outputs[i-1] + outputs[i+from_]
-                outputs[i] = x
-
-            elif module_type == 'yolo':
-                
-                anchors = self.module_list[i][0].anchors
-                #Get the input dimensions
-                inp_dim = int (self.net_info["height"])
-                
-                #Get the number of classes
-                num_classes = int(self.net_info["classes"])
-
-                #Output the result
-                if not self.training:
+            elif kind == "shortcut":
+                x = outputs[inputs[0]] + outputs[inputs[1]]
+            
+            elif kind == "yolo":
+                if self.training:
+                    detections.append(self.module_list[i][0](x, inp_dim, self.num_classes, train=True))
+                elif sparse:
                     x = x.data
-                
-                x = predict_transform(x, inp_dim, anchors, num_classes, train=self.training)
-                
-                if type(x) == int:
-                    continue
-                
-                if not write:
-                    detections = x
-                    write = 1
+                    detections.append(self.module_list[i][0](x, inp_dim, self.num_classes, confidence=confidence))
                 else:
-                    detections = torch.cat((detections, x), 1)
-                
-                outputs[i] = outputs[i-1]
-                
+                    x = x.data
+                    start, end = slices[i]
+                    self.module_list[i][0](x, inp_dim, self.num_classes, out=detections[:, start:end])
+            
+            if save:
+                outputs[i] = x
+            
+            #Drop the outputs nobody reads anymore
+            for j in free:
+                del outputs[j]
         
+        if self.training:
+            if not detections:
+                return 0
+            return torch.cat(detections, 1)
         
-        try:
-            return detections
-        except:
-            return 0
+        if sparse:
+            if not detections:
+                return 0
+            #Image major like the dense output, so NMS breaks ties the same way
+            detections = torch.cat(detections, 0)
+            order = torch.sort(detections[:,0], stable=True)[1]
+            return detections[order]
+        
+        return detections
 
+    
+    def tta(self, x, confidence, nms_conf=0.4, scales=(1.0,), flips=(False, True), merge="wbf", heads=None,
+            max_boxes=1000):
+        """
+        Test-time augmented detections of a batch, all views in one forward
+        (see tta.py). Returns the rows of `write_results`
+        """
+        return detect_tta(self, x, confidence, nms_conf, scales, flips, merge, heads, max_boxes)
+            
+    def weight_layout(self):
+        """
+        Yields (module, attribute name) of every tensor stored in a darknet
+        weights file, in file order
+        """
+        if self.fused:
+            raise RuntimeError("The batch norm layers have been folded by fuse()")
+        
+        for i in range(len(self.module_list)):
+            if self.blocks[i + 1]["type"] != "convolutional":
+                continue
+            
+            model = self.module_list[i]
+            conv = model[0]
+            if "batch_normalize" in self.blocks[i + 1] and int(self.blocks[i + 1]["batch_normalize"]):
+                bn = model[1]
+                yield bn, "bias"
+                yield bn, "weight"
+                yield bn, "running_mean"
+                yield bn, "running_var"
+            else:
+                yield conv, "bias"
+            yield conv, "weight"
+    
+    def num_weights(self, stop = None):
+        """
+        Number of float32 values `load_weights` reads from a weights file
+        for this cfg, up to layer `stop` if given
+        """
+        total = 0
+        for i in range(len(self.module_list)):
+            if stop != None and (i == stop + 1):
+                break
             
-    def load_weights(self, weightfile, stop = None):
+            if self.blocks[i + 1]["type"] == "convolutional":
+                model = self.module_list[i]
+                conv = model[0]
+                if "batch_normalize" in self.blocks[i + 1] and int(self.blocks[i + 1]["batch_normalize"]):
+                    total += 4*conv.out_channels
+                else:
+                    total += conv.bias.numel()
+                total += conv.weight.numel()
+        
+        return total
+            
+    def load_weights(self, weightfile, stop = None, mmap = False):
+        """
+        Loads darknet weights. With mmap the file is memory-mapped instead of
+        read into memory, its size is checked against the cfg before anything
+        is copied and every block is copied straight from the mapping into 
+        the parameters
+        """
+        if self.fused:
+            raise RuntimeError("Load the weights before calling fuse()")
         
         #Open the weights file
         fp = open(weightfile, "rb")
@@ -424,7 +811,19 @@ class Darknet(nn.Module):
         
         #The rest of the values are the weights
         # Let's load them up
-        weights = np.fromfile(fp, dtype = np.float32)
+        if mmap:
+            #Copy-on-write mapping so the slices are writable for torch.from_numpy,
+            #nothing is ever written back to the file
+            weights = np.memmap(weightfile, dtype = np.float32, mode = "c", offset = header.nbytes)
+            fp.close()
+            
+            expected = self.num_weights(stop)
+            if weights.size < expected or (stop == None and weights.size != expected):
+                raise ValueError("{} holds {} weights but the cfg expects {}".format(
+                    weightfile, weights.size, expected))
+        else:
+            weights = np.fromfile(fp, dtype = np.float32)
+            fp.close()
         
         
         ptr = 0
@@ -526,7 +925,16 @@ class Darknet(nn.Module):
                     
                 conv = model[0]
 
-                if (batch_normalize):
+                if (batch_normalize) and self.fused:
+                    #The batch norm was folded into the conv by fuse(), write it
+                    #back as an identity batch norm carrying the folded bias
+                    num_bn_biases = conv.out_channels
+                    cpu(conv.bias.data).numpy().tofile(fp)
+                    np.ones(num_bn_biases, dtype = np.float32).tofile(fp)
+                    np.zeros(num_bn_biases, dtype = np.float32).tofile(fp)
+                    np.full(num_bn_biases, 1 - self.fuse_eps, dtype = np.float32).tofile(fp)
+                
+                elif (batch_normalize):
                     bn = model[1]
                 
                     #If the parameters are on GPU, convert them back to CPU
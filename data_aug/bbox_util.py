@@ -285,36 +285,77 @@ def get_enclosing_box(corners):
 
 
     
-def letterbox_image(img, inp_dim):
-    '''resize image with unchanged aspect ratio using padding
+def letterbox_into(img, canvas, interpolation = cv2.INTER_LINEAR, fill = 0):
+    '''resize image with unchanged aspect ratio into a preallocated canvas
+    
+    The resized image is written straight into its place on the canvas and
+    only the borders around it are filled, nothing else is allocated
     
     Parameters
     ----------
     
     img : numpy.ndarray
-        Image 
+        Image (uint8, `HxWxC`)
+    
+    canvas: numpy.ndarray
+        uint8 array of the network input shape `HxWxC`, written in place
     
-    inp_dim: tuple(int)
-        shape of the reszied image
+    interpolation: int
+        cv2 interpolation flag of the resize
+    
+    fill: int
+        Value of the padding
         
     Returns
     -------
     
     numpy.ndarray:
-        Resized image
+        canvas
     
     '''
-
-    inp_dim = (inp_dim, inp_dim)
-    img_w, img_h = img.shape[1], img.shape[0]
-    w, h = inp_dim
+    #cv2 only resizes into dst when the types match
+    if img.dtype != canvas.dtype:
+        img = img.astype(canvas.dtype)
+    
+    img_h, img_w = img.shape[0], img.shape[1]
+    h, w = canvas.shape[0], canvas.shape[1]
     new_w = int(img_w * min(w/img_w, h/img_h))
     new_h = int(img_h * min(w/img_w, h/img_h))
-    resized_image = cv2.resize(img, (new_w,new_h))
+    top, left = (h - new_h)//2, (w - new_w)//2
     
-    canvas = np.full((inp_dim[1], inp_dim[0], 3), 0)
-
-    canvas[(h-new_h)//2:(h-new_h)//2 + new_h,(w-new_w)//2:(w-new_w)//2 + new_w,  :] = resized_image
+    canvas[:top] = fill
+    canvas[top + new_h:] = fill
+    canvas[top:top + new_h, :left] = fill
+    canvas[top:top + new_h, left + new_w:] = fill
+    
+    cv2.resize(img, (new_w, new_h), dst = canvas[top:top + new_h, left:left + new_w],
+               interpolation = interpolation)
     
     return canvas
 
+    
+def letterbox_image(img, inp_dim, interpolation = cv2.INTER_LINEAR):
+    '''resize image with unchanged aspect ratio using padding
+    
+    Parameters
+    ----------
+    
+    img : numpy.ndarray
+        Image 
+    
+    inp_dim: int
+        side of the reszied (square) image
+    
+    interpolation: int
+        cv2 interpolation flag of the resize
+        
+    Returns
+    -------
+    
+    numpy.ndarray:
+        Resized image (uint8)
+    
+    '''
+    canvas = np.empty((inp_dim, inp_dim, 3), dtype = np.uint8)
+    return letterbox_into(img, canvas, interpolation)
+
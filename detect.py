@@ -9,13 +9,14 @@ from util import *
 import argparse
 import os 
 import os.path as osp
-from darknet import Darknet
-from preprocess import prep_image, inp_to_image, inferset
+from preprocess import prep_image, inp_to_image, inferset, detection_loader
+from resources import get_classes, get_palette, get_model
+from sinks import open_sink, merge_parts, remove_parts, sink_type
 import pandas as pd
 import random 
-import pickle as pkl
 import itertools
-from torch.utils.data import DataLoader
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 
 
 class test_net(nn.Module):
@@ -62,8 +63,14 @@ def arg_parse():
                         "Image / Directory to store detections to",
                         default = "det", type = str)
     parser.add_argument("--bs", dest = "bs", help = "Batch size", default = 1)
+    parser.add_argument("--workers", dest = "workers", help = "Processes to shard the images over",
+                        default = 1, type = int)
+    parser.add_argument("--threads", dest = "threads", help = "Torch threads per worker, cores / workers by default",
+                        default = 0, type = int)
     parser.add_argument("--confidence", dest = "confidence", help = "Object Confidence to filter predictions", default = 0.5)
     parser.add_argument("--nms_thresh", dest = "nms_thresh", help = "NMS Threshhold", default = 0.4)
+    parser.add_argument("--nms_engine", dest = "nms_engine", help = "NMS implementation, loop or batched",
+                        default = "batched", choices = ["loop", "batched"], type = str)
     parser.add_argument("--cfg", dest = 'cfgfile', help = 
                         "Config file",
                         default = "cfg/yolov3.cfg", type = str)
@@ -75,145 +82,193 @@ def arg_parse():
                         default = "416", type = str)
     parser.add_argument("--scales", dest = "scales", help = "Scales to use for detection",
                         default = "1,2,3", type = str)
+    parser.add_argument("--fuse", dest = "fuse", help = "Fold batch norm layers into the convolutions",
+                        action = "store_true")
+    parser.add_argument("--loader_workers", dest = "loader_workers", help = "DataLoader processes decoding images",
+                        default = 0, type = int)
+    parser.add_argument("--prefetch", dest = "prefetch", help = "Pinned batches, copied to the GPU while the previous batch runs",
+                        action = "store_true")
+    parser.add_argument("--out", dest = "out", help = "Detections file, .csv, .npz or .parquet (det/detections.csv by default)",
+                        default = None, type = str)
+    parser.add_argument("--render", dest = "render", help = "Also write the images with the boxes drawn to --det",
+                        action = "store_true")
+    parser.add_argument("--names", dest = "namesfile", help = "Class names, or a .data file pointing to them",
+                        default = "data/coco.names", type = str)
+    parser.add_argument("--tta", dest = "tta", help = "Test-time augmentation, detect on flipped and downscaled views too",
+                        action = "store_true")
+    parser.add_argument("--tta_scales", dest = "tta_scales", help = "Image scales of the TTA views, in (0, 1]",
+                        default = "1,0.83,0.67", type = str)
+    parser.add_argument("--tta_merge", dest = "tta_merge", help = "Merging of the TTA views, wbf or nms",
+                        default = "wbf", type = str)
+    parser.add_argument("--tta_max_boxes", dest = "tta_max_boxes", help = "Most confident boxes of every TTA view merged, 0 for all",
+                        default = 1000, type = int)
     
     return parser.parse_args()
 
-if __name__ ==  '__main__':
-    args = arg_parse()
+def shard(imlist, num_shards):
+    """Splits imlist into num_shards contiguous parts of (nearly) equal size"""
+    size, extra = divmod(len(imlist), num_shards)
+    shards = []
+    start = 0
+    for i in range(num_shards):
+        end = start + size + (i < extra)
+        shards.append(imlist[start:end])
+        start = end
+    return shards
+
+
+def detect_shard(part, imlist, args, threads = None, first_id = 0):
+    """
+    Runs detection over imlist and writes the detections to part (see 
+    sinks.py), the images of imlist having ids from first_id on. With 
+    args.render the annotated images go to args.det as well
+    
+    Returns
+    -------
+    number of images, number of detections, seconds spent detecting
+    """
+    if threads:
+        torch.set_num_threads(threads)
     
-    scales = args.scales
-    images = args.images
     batch_size = int(args.bs)
     confidence = float(args.confidence)
     nms_thesh = float(args.nms_thresh)
-    start = 0
 
     CUDA = torch.cuda.is_available()
     
     device = torch.device("cuda:0" if CUDA else "cpu")
 
-    num_classes = 80
-    classes = load_classes('data/coco.names') 
+    classes = get_classes(args.namesfile)
 
-    #Set up the neural network
-    print("Loading network.....")
-    model = Darknet(args.cfgfile)
-    model.load_weights(args.weightsfile)
-    print("Network successfully loaded")
+    #Set up the neural network, shared (see resources.get_model), on the 
+    #device and in evaluation mode
+    model = get_model(args.cfgfile, args.weightsfile, device = device, fuse = args.fuse)
+    num_classes = model.num_classes
     
-    model.net_info["height"] = args.reso
-    inp_dim = int(model.net_info["height"])
+    inp_dim = int(args.reso)
     assert inp_dim % 32 == 0 
     assert inp_dim > 32
     
-    scales = [int(x) for x in scales.split(',')]
-    scale_inds = model.get_scale_inds(scales, inp_dim)
-
-    #If there's a GPU availible, put the model on GPU
-    model = model.to(device)
+    #Only the selected yolo layers (and what feeds them) are computed
+    heads = [int(x) for x in args.scales.split(',') if int(x) <= len(model.yolo_layers())]
+    tta_scales = [float(x) for x in args.tta_scales.split(',')]
     
+    if args.render:
+        colors = get_palette()
     
-    #Set the model in evaluation mode
-    model.eval()
+    #The loader hands over the decoded originals for drawing with the batch
+    test = inferset(args.images, inp_dim, imlist = imlist, originals = args.render)
+    imloader = detection_loader(test, batch_size, device, args.loader_workers, args.prefetch)
     
-    read_dir = time.time()
+    num_detections = 0
+    
+    start_det_loop = time.time()
+    
+    with open_sink(part) as sink:
+        for ind, batch, dim, *originals in imloader:
+            #load the image 
+            start = time.time()
+            batch = batch.to(device)
+            
+            if args.tta:
+                #All the views in one forward, merged per image
+                prediction = model.tta(batch, confidence, nms_thesh, scales = tta_scales,
+                                       merge = args.tta_merge, heads = heads,
+                                       max_boxes = args.tta_max_boxes or None)
+            else:
+                with torch.no_grad():
+                    prediction = model(batch, heads = heads)
+          
+                #get the boxes with object confidence > threshold
+                #Convert the cordinates to absolute coordinates
+                #perform NMS on these boxes, and save the results 
+                prediction = write_results(prediction, confidence, num_classes, nms = True, nms_conf = nms_thesh,
+                                           engine = args.nms_engine)
+            
+            if type(prediction) == int:
+                continue
+
+            end = time.time()
+                
+            batch_imlist = [imlist[i] for i in [int(a) for a in ind]]
 
-    write = False
+            for im_num, image in enumerate(batch_imlist):
+                objs = [classes[int(x[-1])] for x in prediction if int(x[0]) == im_num]
+                print("{0:20s} predicted in {1:6.3f} seconds".format(image.split("/")[-1], (end - start)/len(batch_imlist)))
+                print("{0:20s} {1:s}".format("Objects Detected:", " ".join(objs)))
+                print("----------------------------------------------------------")
+            
+            if CUDA:
+                torch.cuda.synchronize()
+                
+            im_dim_list = torch.stack(dim, 1).to(device)
+        
+            prediction = de_letter_box(prediction, im_dim_list, inp_dim)
+            
+            sink.write(prediction, batch_imlist, [first_id + int(a) for a in ind])
+            num_detections += prediction.size(0)
+            
+            if args.render:
+                orig_ims = [im.numpy() for im in originals[0]]
+                write_preds(prediction, batch_imlist, args.det, classes, colors, orig_ims)
     
-    colors = pkl.load(open("pallete", "rb"))
+    return len(imlist), num_detections, time.time() - start_det_loop
+
+
+if __name__ ==  '__main__':
+    args = arg_parse()
     
     load_batch = time.time()
     
-    test = inferset("imgs")
+    if osp.isdir(args.images):
+        imlist = sorted(osp.join(args.images, x) for x in os.listdir(args.images))
+    else:
+        imlist = [args.images]
+    
+    if not osp.exists(args.det):
+        os.makedirs(args.det)
     
     read_dir = time.time()
     
-    imlist = test.imlist()
+    #Every worker gets a contiguous shard of the images and its share of 
+    #the cores for its torch thread pool
+    workers = max(1, min(args.workers, len(imlist)))
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    threads = args.threads or max(1, cores // workers)
     
-    batch_size = 4
-    imloader = DataLoader(test, batch_size, num_workers = 0)
-
+    detfile = args.out or osp.join(args.det, "detections.csv")
+    sink_type(detfile)
     
     start_det_loop = time.time()
     
-    batch_num = 0
-    for ind, batch, dim in imloader:
-        #load the image 
-        start = time.time()
-        batch = batch.to(device)
-        
-
-        #Apply offsets to the result predictions
-        #Tranform the predictions as described in the YOLO paper
-        #flatten the prediction vector 
-        # B x (bbox cord x no. of anchors) x grid_w x grid_h --> B x bbox x (all the boxes) 
-        # Put every proposed box as a row.
-        with torch.no_grad():
-            prediction = model(Variable(batch))
-        
-        prediction = prediction[:,scale_inds]
-  
-        #get the boxes with object confidence > threshold
-        #Convert the cordinates to absolute coordinates
-        #perform NMS on these boxes, and save the results 
-        #I could have done NMS and saving seperately to have a better abstraction
-        #But both these operations require looping, hence 
-        #clubbing these ops in one loop instead of two. 
-        #loops are slower than vectorised operations. 
+    if workers == 1:
+        results = [detect_shard(detfile, imlist, args, threads)]
+    else:
+        base, ext = osp.splitext(detfile)
+        jobs = []
+        first_id = 0
+        for i, images in enumerate(shard(imlist, workers)):
+            jobs.append(("{}.part{:03d}{}".format(base, i, ext), images, args, threads, first_id))
+            first_id += len(images)
         
-        prediction = write_results(prediction, confidence, num_classes, nms = True, nms_conf = nms_thesh)
-        
-        if type(prediction) == int:
-            continue
-
-        end = time.time()
-
-            
-        batch_imlist = [imlist[ind] for ind in [int(a) for a in ind]]
-
+        #spawn, forked children inherit the parent's OpenMP state. The 
+        #executor's processes are not daemonic (unlike a Pool's), so a shard 
+        #may start its own DataLoader workers (--loader_workers)
+        ctx = mp.get_context("spawn")
+        parts = [job[0] for job in jobs]
+        try:
+            with ProcessPoolExecutor(workers, mp_context = ctx) as pool:
+                results = list(pool.map(detect_shard, *zip(*jobs)))
+            merge_parts(parts, detfile)
+        finally:
+            remove_parts(parts)
     
-        for im_num, image in enumerate(batch_imlist):
-            objs = [classes[int(x[-1])] for x in prediction if int(x[0]) == im_num]
-            print("{0:20s} predicted in {1:6.3f} seconds".format(image.split("/")[-1], (end - start)/batch_size))
-            print("{0:20s} {1:s}".format("Objects Detected:", " ".join(objs)))
-            print("----------------------------------------------------------")
-        
-        
-        
-        if CUDA:
-            torch.cuda.synchronize()
-            
-        im_dim_list = torch.stack(dim, 1).to(device)
-
-
-    
-        prediction = de_letter_box(prediction, im_dim_list, inp_dim)
-        
-        
-        
-        
-        write_preds(prediction, batch_imlist, args.det, classes, colors)
-        
-        prediction[:,0] += batch_num*batch_size
-        batch_num += 1
-        
-        
-        if not write:
-            output = prediction
-            write = 1
-        else:
-            output = torch.cat((output,prediction))
-            
-            
     detection_fin = time.time() 
-    try:
-        output
-    except NameError:
+    
+    if sum(num_detections for _, num_detections, _ in results) == 0:
         print("No detections were made")
         exit()
     
-    end = time.time()
-    
     print()
     print("SUMMARY")
     print("----------------------------------------------------------")
@@ -222,13 +277,9 @@ if __name__ ==  '__main__':
     print("{:25s}: {:2.3f}".format("Reading addresses", read_dir - load_batch))
     print("{:25s}: {:2.3f}".format("Detection (" + str(len(imlist)) +  " images)", detection_fin - start_det_loop))
     print("{:25s}: {:2.3f}".format("Average time_per_img", (detection_fin - load_batch)/len(imlist)))
+    print("{:25s}: {} x {} threads".format("Workers", workers, threads))
+    print("{:25s}: {}".format("Detections", detfile))
     print("----------------------------------------------------------")
 
     
     torch.cuda.empty_cache()
-    
-    
-        
-        
-    
-    
@@ -238,30 +238,16 @@ def center_to_corner_2d(boxes):
     
     return boxes
 
-if __name__ == "__main__":
-    args = arg_parse()
-
-    # Instantiate a model
-    model = Darknet(args.cfgfile, train=False)
-
-    # Get model specs
-    inp_dim = int(model.net_info["height"])
-    assert inp_dim % 32 == 0 
-    assert inp_dim > 32
-    num_classes = int(model.net_info["classes"])
+def evaluate(model, ann_file, inp_dim, num_classes, device=device):
+    """
+    Runs the model over every image listed in ann_file and scores its
+    predictions against the labels with `custom_eval`
+    """
     bbox_attrs = 5 + num_classes
 
-    # Load weights PyTorch style
-    model.load_state_dict(torch.load(args.weightsfile))
-
-    # Set to evaluation (don't accumulate gradients)
-    model.eval()
-
-    model = model.to(device)  ## Really? You're gonna eval on the CPU? :)
-
     # Load test data and resize only
     transforms = Sequence([YoloResize(inp_dim)])
-    test_data = CustomDataset(root="data", ann_file="data/test.txt", det_transforms=transforms)
+    test_data = CustomDataset(root="data", ann_file=ann_file, det_transforms=transforms)
     test_loader = DataLoader(test_data, batch_size=1)
 
     ground_truths_all = []
@@ -328,5 +314,28 @@ if __name__ == "__main__":
             # print('ground_truth_all ', ground_truths_all)
             # print('predictions_all ', predictions_all)
 
-    prec, rec, aps = custom_eval(predictions_all, ground_truths_all, num_gts=num_gts, ovthresh=0.3)
+    return custom_eval(predictions_all, ground_truths_all, num_gts=num_gts, ovthresh=0.3)
+
+if __name__ == "__main__":
+    args = arg_parse()
+
+    # Instantiate a model
+    model = Darknet(args.cfgfile, train=False)
+
+    # Get model specs
+    inp_dim = int(model.net_info["height"])
+    assert inp_dim % 32 == 0 
+    assert inp_dim > 32
+    num_classes = int(model.net_info["classes"])
+    bbox_attrs = 5 + num_classes
+
+    # Load weights PyTorch style
+    model.load_state_dict(torch.load(args.weightsfile))
+
+    # Set to evaluation (don't accumulate gradients)
+    model.eval()
+
+    model = model.to(device)  ## Really? You're gonna eval on the CPU? :)
+
+    prec, rec, aps = evaluate(model, "data/test.txt", inp_dim, num_classes)
     print(prec, rec, np.mean(aps))
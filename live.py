@@ -5,14 +5,15 @@ import torch.nn as nn
 from torch.autograd import Variable
 import numpy as np
 import cv2 
-from util import de_letter_box, write_results, load_classes
-from darknet import Darknet
-from preprocess import prep_image, inp_to_image, letterbox_image
+from util import write_results, write_results_sparse, split_detections
+from preprocess import inp_to_image
+from preprocess import prep_frame as prep_image
+from pipeline import frame_batches, scale_to_frame
+from resources import get_classes, get_palette, get_model
 from bbox import center_to_corner, bbox_iou, corner_to_center_2d
 
 import pandas as pd
 import random 
-import pickle as pkl
 import argparse
 
 
@@ -29,25 +30,12 @@ def get_test_input(input_dim, CUDA):
     
     return img_
 
-def prep_image(img, inp_dim):
-    """
-    Prepare image for inputting to the neural network. 
-    
-    Returns a Variable 
-    """
-    orig_im = img
-    dim = orig_im.shape[1], orig_im.shape[0]
-    img = (letterbox_image(orig_im, (inp_dim, inp_dim)))
-    img_ = img[:,:,::-1].transpose((2,0,1)).copy()
-    img_ = torch.from_numpy(img_).float().div(255.0).unsqueeze(0)
-    return img_, orig_im, dim
-
 def write(x, img):
     """
     Arguments
     ---------
     x : array of float
-        [label_index, x_center, y_center, width, height]
+        [batch_index, x1, y1, x2, y2, objectness, class_confidence, class_index]
     img : numpy array
         original image
 
@@ -62,10 +50,10 @@ def write(x, img):
         # # needs to be bottom, right
         # c2 = tuple(x[3:5].int())
         # needs to be top, left
-        c1 = tuple(x[1:3].int())
+        c1 = tuple(int(v) for v in x[1:3])
         # needs to be bottom, right
-        c2 = tuple(x[3:5].int())
-        label = int(x[0])
+        c2 = tuple(int(v) for v in x[3:5])
+        label = int(x[-1])
         print(label)
         label="{0}".format(classes[label])
         color = random.choice(colors)
@@ -86,6 +74,8 @@ def arg_parse():
     parser.add_argument("--dataset", dest="dataset", help="Dataset on which the network has been trained", default="pascal")
     parser.add_argument("--confidence", dest="confidence", help="Object Confidence to filter predictions", default = 0.5)
     parser.add_argument("--nms_thresh", dest="nms_thresh", help="NMS Threshhold", default = 0.4)
+    parser.add_argument("--nms_engine", dest="nms_engine", help="NMS implementation, loop or batched",
+                        default="batched", choices=["loop", "batched"], type = str)
     parser.add_argument("--cfg", dest='cfgfile', help = 
                         "Config file",
                         default="cfg/yolov3.cfg", type = str)
@@ -97,6 +87,14 @@ def arg_parse():
     parser.add_argument("--reso", dest='reso', help = 
                         "Input resolution of the network. Increase to increase accuracy. Decrease to increase speed",
                         default="416", type = str)
+    parser.add_argument("--fuse", dest="fuse", help="Fold batch norm layers into the convolutions",
+                        action="store_true")
+    parser.add_argument("--prune", dest="prune", help="Drop low objectness anchors in the yolo layers before decoding",
+                        action="store_true")
+    parser.add_argument("--bs", dest="bs", help="Most frames per forward",
+                        default=1, type=int)
+    parser.add_argument("--batch_wait", dest="batch_wait", help="Milliseconds to wait for a batch to fill",
+                        default=50, type=float)
     return parser.parse_args()
 
 
@@ -111,19 +109,18 @@ if __name__ == '__main__':
     device = torch.device("cuda:0" if CUDA else "cpu")
     
     print("Loading network.....")
-    model = Darknet(cfgfile=args.cfgfile, train=False)
-    model.load_state_dict(torch.load(args.weightsfile))
+    #Shared (see resources.get_model), on device and in evaluation mode
+    model = get_model(args.cfgfile, args.weightsfile, device=device, fuse=args.fuse)
     print("Network successfully loaded")
 
-    model.net_info["height"] = args.reso
-    inp_dim = int(model.net_info["height"])
+    inp_dim = int(args.reso)
     assert inp_dim % 32 == 0 
     assert inp_dim > 32
     num_classes = int(model.net_info["classes"])
     bbox_attrs = 5 + num_classes
 
-    model = model.to(device)
-    model.eval()
+    classes = get_classes(args.datafile)
+    colors = get_palette()
     
     if args.video: # video file
         videofile = args.video
@@ -133,55 +130,40 @@ if __name__ == '__main__':
     assert cap.isOpened(), 'Cannot capture source'
     
     frames = 0
-    start = time.time()    
-    while cap.isOpened():
+    start = time.time()
+    stop = False
+    # frames are run through the network in batches of up to --bs frames
+    for batch in frame_batches(cap, args.bs, args.batch_wait/1000):
+        img = torch.cat([prep_image(frame, inp_dim)[0] for frame in batch]).to(device)
         
-        ret, frame = cap.read()
-        if ret:
-            img, orig_im, orig_im_dim = prep_image(frame, inp_dim)
-            orig_im_dim = torch.FloatTensor(orig_im_dim).to(device)                    
-            
-            img = img.to(device)
-            
-            with torch.no_grad():   
+        # write_results does center to corner, returns [batch_ind, output]
+        with torch.no_grad():   
+            if args.prune:
+                output = model(img, confidence=confidence)
+                output = write_results_sparse(output, num_classes, nms=True, nms_conf=nms_thesh)
+            else:
                 output = model(img)
-            # write_results does center to corner, returns [batch_ind, output]
-            output = write_results(output, confidence, num_classes, nms=True, nms_conf=nms_thesh)
-
-            if type(output) == int:
-                frames += 1
-                print("FPS of the video is {:5.2f}".format( frames / (time.time() - start)))
-                cv2.imshow("frame", orig_im)
-                key = cv2.waitKey(1)
-                if key & 0xFF == ord('q'):
-                    break
-                continue
+                output = write_results(output, confidence, num_classes, nms=True, nms_conf=nms_thesh,
+                                       engine=args.nms_engine)
 
-            output = de_letter_box(output, orig_im_dim, inp_dim)
+        if type(output) != int:
             print('output ', output)
-            classes = load_classes(args.datafile)
-            colors = pkl.load(open("pallete", "rb"))
-
-            # output[:, 1] *= orig_im_dim[0]/inp_dim
-            # output[:, 2] *= orig_im_dim[1]/inp_dim
-            # output[:, 3] *= orig_im_dim[0]/inp_dim
-            # output[:, 4] *= orig_im_dim[1]/inp_dim
-
-            # convert x1, y1, x2, y2 to top, left, bottom, right
-            # output[:, 1] = output[:, 4]
-            # output[:, 2] = output[:, 1]
-            # output[:, 3] = output[:, 2]
-            # output[:, 4] = output[:, 3]
 
-            list(map(lambda x: write(x, orig_im), output))
+        # back to one frame at a time, in capture order, boxes mapped from the
+        # letterboxed input to the frame like pipeline.py does
+        for orig_im, detections in zip(batch, split_detections(output, len(batch))):
+            if detections is not None:
+                detections = scale_to_frame(detections, (orig_im.shape[1], orig_im.shape[0]), inp_dim)
+                list(map(lambda x: write(x, orig_im), detections))
+                cv2.imwrite('detection.png', orig_im)
             
             cv2.imshow("frame", orig_im)
-            cv2.imwrite('detection.png', orig_im)
             key = cv2.waitKey(1)
             if key & 0xFF == ord('q'):
+                stop = True
                 break
             frames += 1
             print("FPS of the video is {:5.2f}".format( frames / (time.time() - start)))
 
-        else:
+        if stop:
             break
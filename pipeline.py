@@ -0,0 +1,503 @@
+"""
+Streaming video inference pipeline.
+
+The serial demo loop (read, letterbox, forward, NMS, draw, show) leaves the
+CPU idle on decode while the model runs and the other way round. Here every
+step runs in its own stage, connected by bounded queues:
+
+    capture thread -> preprocess pool -> inference (batched) -> annotate/write
+
+The capture thread hands frames to a pool of letterbox workers and queues
+the pending results in frame order, so batches always hold consecutive
+frames. When a queue is full the drop policy decides what happens:
+"block" back-pressures the stage before it (offline video, every frame
+is processed), "oldest" drops the oldest queued frame and "newest" drops
+the incoming frame (live sources, bounded latency).
+
+e.g. python pipeline.py --video video.avi --cfg cfg/yolov3-tiny.cfg \
+         --weights yolov3-tiny.weights --names data/obj.names --out annotated.avi
+
+"""
+
+from __future__ import division
+import argparse
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+
+from preprocess import get_letterbox
+from resources import get_classes, get_palette, get_model
+from util import write_results, write_results_sparse, split_detections
+
+#Marks the end of the stream, never dropped
+END = None
+
+DROP_POLICIES = ("block", "oldest", "newest")
+
+
+class FrameQueue(object):
+    """
+    Bounded queue between two stages
+
+    Arguments
+    ---------
+    maxsize : int
+        Number of items the queue holds
+
+    drop : str
+        What `put` does when the queue is full: "block" waits for room,
+        "oldest" drops the oldest queued item, "newest" drops the new item
+    """
+    def __init__(self, maxsize, drop="block"):
+        if drop not in DROP_POLICIES:
+            raise ValueError("Unknown drop policy {}, use one of {}".format(drop, DROP_POLICIES))
+        self.queue = queue.Queue(maxsize)
+        self.drop = drop
+        self.dropped = 0
+        self.ended = False
+
+    def put(self, item):
+        if self.drop == "block" or item is END:
+            self.queue.put(item)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+
+            if self.drop == "newest":
+                self.dropped += 1
+                return
+
+            try:
+                old = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            if old is END:
+                #Keep the end marker, the stream is over anyway
+                self.queue.put(old)
+                self.dropped += 1
+                return
+            self.dropped += 1
+
+    def get(self, timeout=None):
+        item = self.queue.get(timeout=timeout)
+        if item is END:
+            self.ended = True
+        return item
+
+    def get_nowait(self):
+        item = self.queue.get_nowait()
+        if item is END:
+            self.ended = True
+        return item
+
+    def drain(self):
+        """
+        Discards items up to the end marker, so the stage putting into the
+        queue is never left blocked on a consumer that stopped
+        """
+        while not self.ended:
+            self.get()
+
+
+def frame_batches(cap, batch_size=1, max_wait=None):
+    """
+    Yields lists of consecutive frames read from cap, batch_size frames at 
+    most. A batch is cut short once max_wait seconds passed since its first
+    frame was read (never when max_wait is None), so a slow live source 
+    does not hold back the frames already read
+    """
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            return
+        first = time.time()
+        batch = [frame]
+        while len(batch) < batch_size:
+            if max_wait is not None and time.time() - first >= max_wait:
+                break
+            ret, frame = cap.read()
+            if not ret:
+                yield batch
+                return
+            batch.append(frame)
+        yield batch
+
+
+class StageStats(object):
+    """Per item latencies of a stage, in seconds"""
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+        self.lock = threading.Lock()
+
+    def add(self, seconds, count=1):
+        with self.lock:
+            self.times.extend([seconds / count]*count)
+
+    def summary(self):
+        """(count, mean ms, p95 ms)"""
+        if not self.times:
+            return 0, float("nan"), float("nan")
+        times = np.array(self.times)*1000
+        return len(times), times.mean(), np.percentile(times, 95)
+
+
+class Frame(object):
+    """A frame travelling through the pipeline"""
+    def __init__(self, index, image):
+        self.index = index
+        self.image = image
+        self.captured = time.time()
+        self.tensor = None
+        self.detections = None
+
+
+def letterbox_frame(frame, inp_dim):
+    """Letterboxed network input of a frame, 3 x inp_dim x inp_dim"""
+    frame.tensor = get_letterbox(inp_dim)(frame.image)
+    return frame
+
+
+def scale_to_frame(output, im_dim, inp_dim):
+    """
+    Maps boxes from the letterboxed network input back to the frame, in place
+
+    Arguments
+    ---------
+    output : tensor (2D)
+        [batch_index, x1, y1, x2, y2, objectness, class_confidence, class_index]
+
+    im_dim : (width, height) of the frame
+    """
+    w, h = im_dim
+    scaling_factor = min(inp_dim/w, inp_dim/h)
+    output[:,[1,3]] -= (inp_dim - scaling_factor*w)/2
+    output[:,[2,4]] -= (inp_dim - scaling_factor*h)/2
+    output[:,1:5] /= scaling_factor
+    output[:,[1,3]] = torch.clamp(output[:,[1,3]], 0.0, w)
+    output[:,[2,4]] = torch.clamp(output[:,[2,4]], 0.0, h)
+    return output
+
+
+def draw_detections(img, output, classes, colors):
+    """Draws [batch_index, x1, y1, x2, y2, objectness, class_confidence, class_index] rows on img"""
+    for x in output:
+        c1 = tuple(int(v) for v in x[1:3])
+        c2 = tuple(int(v) for v in x[3:5])
+        label = "{0}".format(classes[int(x[-1])])
+        color = random.choice(colors)
+        cv2.rectangle(img, c1, c2, color, 1)
+        t_size = cv2.getTextSize(label, cv2.FONT_HERSHEY_PLAIN, 1 , 1)[0]
+        c2 = c1[0] + t_size[0] + 3, c1[1] + t_size[1] + 4
+        cv2.rectangle(img, c1, c2, color, -1)
+        cv2.putText(img, label, (c1[0], c1[1] + t_size[1] + 4), cv2.FONT_HERSHEY_PLAIN, 1, [225,255,255], 1)
+    return img
+
+
+class VideoPipeline(object):
+    """
+    Staged detection over a cv2.VideoCapture source
+
+    Arguments
+    ---------
+    model : Darknet
+        Model in eval mode, on device
+
+    classes, colors : class names and the palette to draw with
+
+    batch_size : int
+        Most frames per forward
+
+    max_wait : float
+        Seconds the inference stage waits for a batch to fill once its first
+        frame is ready, 0 batches only the frames already waiting
+
+    workers : int
+        Letterbox worker threads (cv2 releases the GIL)
+
+    queue_size : int
+        Capacity of every queue
+
+    drop : str
+        Drop policy of the queues, see `FrameQueue`
+
+    writer : cv2.VideoWriter or None
+        Annotated frames are written to it when given
+
+    display : bool
+        Show the annotated frames, from the thread calling `run`
+    """
+    def __init__(self, model, inp_dim, classes, colors, confidence=0.5, nms_conf=0.4,
+                 batch_size=4, max_wait=0.0, workers=2, queue_size=8, drop="block", device="cpu",
+                 writer=None, display=False, prune=False, nms_engine="batched"):
+        self.model = model
+        self.inp_dim = inp_dim
+        self.classes = classes
+        self.colors = colors
+        self.confidence = confidence
+        self.nms_conf = nms_conf
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.workers = workers
+        self.device = device
+        self.writer = writer
+        self.display = display
+        self.prune = prune
+        self.nms_engine = nms_engine
+
+        self.prepped = FrameQueue(queue_size, drop)
+        self.detected = FrameQueue(queue_size, drop)
+        self.annotated = FrameQueue(queue_size, "block" if display else drop)
+
+        self.stats = {name: StageStats(name) for name in
+                      ["capture", "preprocess", "inference", "annotate", "end to end"]}
+        self.frames = 0
+        self.stopped = threading.Event()
+        self.error = None
+        self.error_lock = threading.Lock()
+
+    def fail(self, error):
+        """Keeps the first error of any stage (raised again by `run`) and stops capturing"""
+        with self.error_lock:
+            if self.error is None:
+                self.error = error
+        self.stop()
+
+    def capture(self, cap, pool):
+        try:
+            index = 0
+            while not self.stopped.is_set():
+                start = time.time()
+                ret, image = cap.read()
+                if not ret:
+                    break
+                self.stats["capture"].add(time.time() - start)
+                self.prepped.put(pool.submit(self.preprocess, Frame(index, image)))
+                index += 1
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.prepped.put(END)
+
+    def preprocess(self, frame):
+        start = time.time()
+        letterbox_frame(frame, self.inp_dim)
+        self.stats["preprocess"].add(time.time() - start)
+        return frame
+
+    def next_batch(self):
+        """
+        Blocks for one frame, then collects frames until there are batch_size
+        of them or max_wait passed
+        """
+        item = self.prepped.get()
+        if item is END:
+            return [], True
+        deadline = time.time() + self.max_wait
+        batch = [item.result()]
+        while len(batch) < self.batch_size:
+            try:
+                item = self.prepped.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if item is END:
+                return batch, True
+            batch.append(item.result())
+        return batch, False
+
+    def detect(self, batch):
+        """Forward and NMS of a list of frames, detections end up on the frames"""
+        img = torch.stack([frame.tensor for frame in batch]).to(self.device)
+        with torch.no_grad():
+            if self.prune:
+                output = self.model(img, confidence=self.confidence)
+                output = write_results_sparse(output, self.model.num_classes, nms=True, nms_conf=self.nms_conf)
+            else:
+                output = self.model(img)
+                output = write_results(output, self.confidence, self.model.num_classes, nms=True,
+                                       nms_conf=self.nms_conf, engine=self.nms_engine)
+
+        if type(output) != int:
+            output = output.cpu()
+        for frame, detections in zip(batch, split_detections(output, len(batch))):
+            frame.detections = detections
+
+    def inference(self):
+        try:
+            done = False
+            while not done:
+                batch, done = self.next_batch()
+                if not batch:
+                    break
+                start = time.time()
+                self.detect(batch)
+                self.stats["inference"].add(time.time() - start, len(batch))
+                for frame in batch:
+                    self.detected.put(frame)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.detected.put(END)
+            self.prepped.drain()
+
+    def annotate(self):
+        try:
+            while True:
+                frame = self.detected.get()
+                if frame is END:
+                    break
+                start = time.time()
+                if frame.detections is not None:
+                    im_dim = frame.image.shape[1], frame.image.shape[0]
+                    scale_to_frame(frame.detections, im_dim, self.inp_dim)
+                    draw_detections(frame.image, frame.detections, self.classes, self.colors)
+                if self.writer is not None:
+                    self.writer.write(frame.image)
+                self.stats["annotate"].add(time.time() - start)
+                self.stats["end to end"].add(time.time() - frame.captured)
+                self.frames += 1
+                self.annotated.put(frame)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.annotated.put(END)
+            self.detected.drain()
+
+    def run(self, cap):
+        """
+        Processes the source until it ends (or q is pressed when displaying)
+
+        Returns the end-to-end frames per second. The first error of any
+        stage is raised once all stages have stopped
+        """
+        start = time.time()
+        with ThreadPoolExecutor(self.workers) as pool:
+            threads = [threading.Thread(target=self.capture, args=(cap, pool), daemon=True),
+                       threading.Thread(target=self.inference, daemon=True),
+                       threading.Thread(target=self.annotate, daemon=True)]
+            for thread in threads:
+                thread.start()
+
+            try:
+                while True:
+                    frame = self.annotated.get()
+                    if frame is END:
+                        break
+                    if self.display:
+                        cv2.imshow("frame", frame.image)
+                        if cv2.waitKey(1) & 0xFF == ord('q'):
+                            self.stop()
+            except Exception as e:
+                self.fail(e)
+                self.annotated.drain()
+
+            for thread in threads:
+                thread.join()
+
+        if self.error is not None:
+            raise self.error
+        return self.frames / (time.time() - start)
+
+    def stop(self):
+        """Stops capturing, the frames already captured are still processed"""
+        self.stopped.set()
+
+    def dropped(self):
+        return self.prepped.dropped + self.detected.dropped + self.annotated.dropped
+
+    def report(self, fps):
+        print("{:12s} {:>8s} {:>10s} {:>10s}".format("stage", "frames", "mean (ms)", "p95 (ms)"))
+        for name in ["capture", "preprocess", "inference", "annotate", "end to end"]:
+            count, mean, p95 = self.stats[name].summary()
+            print("{:12s} {:8d} {:10.1f} {:10.1f}".format(name, count, mean, p95))
+        print("{} frames, {} dropped, {:5.2f} FPS".format(self.frames, self.dropped(), fps))
+
+
+def arg_parse():
+    """
+    Parse arguements to the pipeline module
+
+    """
+    parser = argparse.ArgumentParser(description='YOLO v3 Streaming Video Detection')
+    parser.add_argument("--video", dest = 'video', help = "Video file, the webcam if not given",
+                        default = None, type = str)
+    parser.add_argument("--out", dest = 'out', help = "Write the annotated video here",
+                        default = None, type = str)
+    parser.add_argument("--display", dest = "display", help = "Show the annotated frames",
+                        action = "store_true")
+    parser.add_argument("--confidence", dest = "confidence", help = "Object Confidence to filter predictions",
+                        default = 0.5, type = float)
+    parser.add_argument("--nms_thresh", dest = "nms_thresh", help = "NMS Threshhold",
+                        default = 0.4, type = float)
+    parser.add_argument("--nms_engine", dest = "nms_engine", help = "NMS implementation, loop or batched",
+                        default = "batched", choices = ["loop", "batched"], type = str)
+    parser.add_argument("--cfg", dest = 'cfgfile', help = "Config file",
+                        default = "cfg/yolov3.cfg", type = str)
+    parser.add_argument("--weights", dest = 'weightsfile', help = "Darknet weights or PyTorch state dict",
+                        default = "yolov3.weights", type = str)
+    parser.add_argument("--names", dest = "namesfile", help = "Class names, or a .data file pointing to them",
+                        default = "data/obj.names", type = str)
+    parser.add_argument("--reso", dest = 'reso', help = "Input resolution of the network",
+                        default = "416", type = str)
+    parser.add_argument("--bs", dest = "bs", help = "Most frames per forward",
+                        default = 4, type = int)
+    parser.add_argument("--batch_wait", dest = "batch_wait", help = "Milliseconds to wait for a batch to fill",
+                        default = 0, type = float)
+    parser.add_argument("--workers", dest = "workers", help = "Preprocessing threads",
+                        default = 2, type = int)
+    parser.add_argument("--queue", dest = "queue_size", help = "Capacity of the queues between stages",
+                        default = 8, type = int)
+    parser.add_argument("--drop", dest = "drop", help = "What to do when a queue is full",
+                        default = "block", choices = DROP_POLICIES, type = str)
+    parser.add_argument("--fuse", dest = "fuse", help = "Fold batch norm layers into the convolutions",
+                        action = "store_true")
+    parser.add_argument("--prune", dest = "prune", help = "Drop low objectness anchors in the yolo layers before decoding",
+                        action = "store_true")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+
+    CUDA = torch.cuda.is_available()
+    device = torch.device("cuda:0" if CUDA else "cpu")
+
+    model = get_model(args.cfgfile, args.weightsfile, device=device, fuse=args.fuse)
+
+    inp_dim = int(args.reso)
+    assert inp_dim % 32 == 0
+    assert inp_dim > 32
+
+    classes = get_classes(args.namesfile)
+    colors = get_palette()
+
+    cap = cv2.VideoCapture(args.video if args.video else 0)
+    assert cap.isOpened(), 'Cannot capture source'
+
+    writer = None
+    if args.out:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 25
+        size = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        writer = cv2.VideoWriter(args.out, cv2.VideoWriter_fourcc(*"MJPG"), fps, size)
+
+    pipeline = VideoPipeline(model, inp_dim, classes, colors, args.confidence, args.nms_thresh,
+                             batch_size=args.bs, max_wait=args.batch_wait/1000, workers=args.workers, queue_size=args.queue_size,
+                             drop=args.drop, device=device, writer=writer, display=args.display,
+                             prune=args.prune, nms_engine=args.nms_engine)
+    fps = pipeline.run(cap)
+    cap.release()
+    if writer is not None:
+        writer.release()
+
+    pipeline.report(fps)
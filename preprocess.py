@@ -11,31 +11,82 @@ from util import count_parameters as count
 from util import convert2cpu as cpu
 from PIL import Image, ImageDraw
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
 import os
 import random
+import threading
 from torchvision import transforms
 from data_aug.data_aug import *
-from data_aug.bbox_util import draw_rect
+from data_aug.bbox_util import draw_rect, letterbox_into
 
 
 
-def letterbox_image(img, inp_dim):
+INTERPOLATION = {"nearest": cv2.INTER_NEAREST,
+                 "linear": cv2.INTER_LINEAR,
+                 "area": cv2.INTER_AREA,
+                 "cubic": cv2.INTER_CUBIC}
+
+
+def letterbox_image(img, inp_dim, interpolation = cv2.INTER_CUBIC):
     '''resize image with unchanged aspect ratio using padding'''
-    img_w, img_h = img.shape[1], img.shape[0]
     w, h = inp_dim
-    new_w = int(img_w * min(w/img_w, h/img_h))
-    new_h = int(img_h * min(w/img_w, h/img_h))
-    resized_image = cv2.resize(img, (new_w,new_h), interpolation = cv2.INTER_CUBIC)
-    
-    canvas = np.full((inp_dim[1], inp_dim[0], 3), 128)
+    canvas = np.empty((h, w, 3), dtype = np.uint8)
+    return letterbox_into(img, canvas, interpolation, fill = 128)
 
-    canvas[(h-new_h)//2:(h-new_h)//2 + new_h,(w-new_w)//2:(w-new_w)//2 + new_w,  :] = resized_image
+
+class Letterbox(object):
+    """
+    Letterboxes images into network inputs without intermediate copies.
+    
+    The image is resized straight into a reusable uint8 canvas, then the
+    BGR to RGB swap, HWC to CHW transpose and scaling to [0, 1] happen in
+    one pass that writes the float32 input. Every thread gets its own 
+    canvas, so one instance can serve a pool of workers.
     
-    return canvas
+    Arguments
+    ---------
+    inp_dim : int
+        Side of the (square) network input
+    
+    interpolation : str or int
+        "nearest", "linear", "area", "cubic" or a cv2 flag
+    """
+    def __init__(self, inp_dim, interpolation = "cubic"):
+        self.inp_dim = inp_dim
+        self.interpolation = INTERPOLATION.get(interpolation, interpolation)
+        self.local = threading.local()
+    
+    def canvas(self):
+        canvas = getattr(self.local, "canvas", None)
+        if canvas is None:
+            canvas = np.empty((self.inp_dim, self.inp_dim, 3), dtype = np.uint8)
+            self.local.canvas = canvas
+        return canvas
+    
+    def __call__(self, img, out = None):
+        """
+        Network input of a BGR image, a 3 x inp_dim x inp_dim float tensor.
+        Written into out when given (e.g. a slice of a batch tensor)
+        """
+        canvas = letterbox_into(img, self.canvas(), self.interpolation, fill = 128)
+        if out is None:
+            out = torch.empty(3, self.inp_dim, self.inp_dim)
+        np.divide(canvas[:,:,::-1].transpose((2,0,1)), np.float32(255.0),
+                  out = out.numpy(), casting = "unsafe")
+        return out
 
 
-        
-def prep_image(img, inp_dim):
+_letterboxes = {}
+
+def get_letterbox(inp_dim, interpolation = "cubic"):
+    """Shared `Letterbox` per input size and interpolation"""
+    key = (inp_dim, interpolation)
+    if key not in _letterboxes:
+        _letterboxes[key] = Letterbox(inp_dim, interpolation)
+    return _letterboxes[key]
+
+
+def prep_image(img, inp_dim, interpolation = "cubic"):
     """
     Prepare image for inputting to the neural network. 
     
@@ -44,9 +95,18 @@ def prep_image(img, inp_dim):
 
     orig_im = cv2.imread(img)
     dim = orig_im.shape[1], orig_im.shape[0]
-    img = (letterbox_image(orig_im, (inp_dim, inp_dim)))
-    img_ = img[:,:,::-1].transpose((2,0,1)).copy()
-    img_ = torch.from_numpy(img_).float().div(255.0)
+    img_ = get_letterbox(inp_dim, interpolation)(orig_im)
+    return img_, orig_im, dim
+
+
+def prep_frame(img, inp_dim, interpolation = "cubic"):
+    """
+    Like `prep_image` for an already decoded (video) frame, the input has
+    a batch dimension
+    """
+    orig_im = img
+    dim = orig_im.shape[1], orig_im.shape[0]
+    img_ = get_letterbox(inp_dim, interpolation)(orig_im).unsqueeze(0)
     return img_, orig_im, dim
 
 def prep_image_pil(img, network_dim):
@@ -76,18 +136,27 @@ def inp_to_image(inp):
 class inferset(Dataset):
     """Face Landmarks dataset."""
 
-    def __init__(self, root_dir, inp_dim = 416, transform=None):
+    def __init__(self, root_dir, inp_dim = 416, transform=None, imlist=None, originals=False):
         """
         Args:
             csv_file (string): Path to the csv file with annotations.
             root_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            imlist (list, optional): Image paths to use instead of every 
+                file in root_dir.
+            originals (bool, optional): Also return the decoded original
+                image (as a tensor, so DataLoader workers hand it over in
+                shared memory), for drawing the detections without 
+                decoding it again. Collate with `collate_originals`.
         """
         self.root_dir = root_dir
-        self.list_ims = [os.path.join(root_dir, x) for x in os.listdir(self.root_dir)]
+        if imlist is None:
+            imlist = [os.path.join(root_dir, x) for x in os.listdir(self.root_dir)]
+        self.list_ims = list(imlist)
         self.transform = transform
         self.inp_dim = inp_dim
+        self.originals = originals
 
     def __len__(self):
         return len(self.list_ims)
@@ -98,13 +167,126 @@ class inferset(Dataset):
     def __getitem__(self, idx):
         img = self.list_ims[idx]
         image, orig_im, dim = prep_image(img, self.inp_dim)
+        if self.originals:
+            return idx, image, dim, torch.from_numpy(orig_im)
         return idx, image, dim
+
+
+def collate_originals(items):
+    """
+    default_collate of the (idx, image, dim) of inferset items. The originals
+    (of different sizes) of items that have them stay a list
+    """
+    batch = default_collate([item[:3] for item in items])
+    if len(items[0]) > 3:
+        batch.append([item[3] for item in items])
+    return batch
+
+
+class PinnedCollate(object):
+    """
+    Collates inferset items (idx, image, dim[, original]) into a ring of 
+    reusable pinned batch buffers, for loaders running in the main process 
+    (num_workers = 0). Pinned memory lets the copy to the GPU run 
+    asynchronously, see `DevicePrefetcher`.
     
+    A buffer is overwritten `slots` batches later, so at most slots - 1 
+    batches may be in flight. Two slots double-buffer with DevicePrefetcher,
+    which keeps one copy outstanding.
+    """
+    def __init__(self, slots = 2):
+        self.slots = slots
+        self.buffers = [None]*slots
+        self.next = 0
     
+    def __call__(self, items):
+        ind = torch.tensor([item[0] for item in items])
+        dim = default_collate([item[2] for item in items])
+        
+        images = [item[1] for item in items]
+        shape = (len(images),) + tuple(images[0].shape)
+        
+        buffer = self.buffers[self.next]
+        if buffer is None or buffer.shape[0] < shape[0] or buffer.shape[1:] != shape[1:]:
+            buffer = torch.empty(shape, dtype = images[0].dtype, pin_memory = True)
+            self.buffers[self.next] = buffer
+        self.next = (self.next + 1) % self.slots
+        
+        batch = buffer[:len(images)]
+        torch.stack(images, out = batch)
+        if len(items[0]) > 3:
+            return ind, batch, dim, [item[3] for item in items]
+        return ind, batch, dim
+
 
+class DevicePrefetcher(object):
+    """
+    Iterates over the (idx, batch, dim[, originals]) of a loader with the 
+    batch already on device. On CUDA the next batch is copied on a side 
+    stream while the current one is being used, which needs pinned batches
+    (PinnedCollate or DataLoader(pin_memory = True)). Elsewhere the batches
+    pass through as they are, a DataLoader with workers already hands them
+    over in shared memory without copying.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+    
+    def __len__(self):
+        return len(self.loader)
+    
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for ind, batch, *rest in self.loader:
+                yield (ind, batch.to(self.device), *rest)
+            return
+        
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+        
+        def preload():
+            try:
+                ind, batch, *rest = next(batches)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                batch = batch.to(self.device, non_blocking = True)
+                copied = torch.cuda.Event()
+                copied.record(stream)
+            return ind, batch, rest, copied
+        
+        loaded = preload()
+        while loaded is not None:
+            ind, batch, rest, copied = loaded
+            
+            #The pinned buffer of this batch is free once its copy is done,
+            #only then may the loader collate into the ring again
+            copied.synchronize()
+            loaded = preload()
+            
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(copied)
+            batch.record_stream(current)
+            yield (ind, batch, *rest)
 
 
+def detection_loader(dataset, batch_size, device, num_workers = 0, prefetch = False):
+    """
+    DataLoader over an inferset. With prefetch the batches arrive on device,
+    collated into pinned buffers and copied ahead of time on CUDA
+    """
+    device = torch.device(device)
+    if not prefetch:
+        return DataLoader(dataset, batch_size, num_workers = num_workers, collate_fn = collate_originals)
     
+    cuda = device.type == "cuda"
+    if cuda and num_workers == 0:
+        loader = DataLoader(dataset, batch_size, collate_fn = PinnedCollate())
+    else:
+        loader = DataLoader(dataset, batch_size, num_workers = num_workers, pin_memory = cuda,
+                            collate_fn = collate_originals)
+    return DevicePrefetcher(loader, device)
+
     
 class toyset(Dataset):
 
@@ -0,0 +1,146 @@
+"""
+Post-training static int8 quantization of Darknet for CPU inference.
+
+The batch norm layers are folded first (Darknet.fuse), then every
+convolution with a leaky activation is wrapped between a quantize and a
+dequantize stub and calibrated on images from a list file (the same
+format as data/train.txt). Routes, shortcuts, upsampling and the yolo
+layers (predict_transform) stay in float, as do the linear convolutions
+feeding the yolo layers since their output goes through exp() in the
+decode. A quantized model runs on the CPU only and cannot be exported
+with save_weights.
+
+e.g. python quantize.py --cfg cfg/yolov3-tiny.cfg --weights runs/model.pth \
+         --calib data/train.txt --test data/test.txt
+"""
+
+import argparse
+import copy
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert
+
+from preprocess import prep_image
+from resources import load_model
+
+
+def quantizable_blocks(model):
+    """Indices of the convolutional blocks that run in int8"""
+    return [i for i, block in enumerate(model.blocks[1:])
+            if block["type"] == "convolutional" and block["activation"] == "leaky"]
+
+
+def calibration_batches(list_file, inp_dim, num_images=200, batch_size=8):
+    """Yields letterboxed batches of the first num_images images in list_file"""
+    with open(list_file, "r") as f:
+        paths = [x.rstrip() for x in f.readlines() if x.strip()]
+    paths = paths[:num_images]
+
+    for i in range(0, len(paths), batch_size):
+        yield torch.stack([prep_image(path, inp_dim)[0] for path in paths[i:i + batch_size]])
+
+
+def prepare_int8(model, engine=None):
+    """
+    Folds the batch norms of a float model, wraps the quantizable blocks with
+    quant/dequant stubs and inserts the calibration observers, in place
+    """
+    if engine is not None:
+        torch.backends.quantized.engine = engine
+    qconfig = get_default_qconfig(torch.backends.quantized.engine)
+
+    model.fuse()
+    for i in quantizable_blocks(model):
+        conv = model.module_list[i][0]
+        #quantized leaky relu does not work in place
+        block = nn.Sequential(OrderedDict([("quant", QuantStub()),
+                                           ("conv_{0}".format(i), conv),
+                                           ("leaky_{0}".format(i), nn.LeakyReLU(0.1)),
+                                           ("dequant", DeQuantStub())]))
+        block.qconfig = qconfig
+        model.module_list[i] = block
+
+    return prepare(model, inplace=True)
+
+
+def quantize_darknet(model, list_file, num_images=200, batch_size=8, engine=None):
+    """
+    Quantizes a float Darknet in place, calibrating the activation ranges on
+    the first num_images images of list_file
+
+    Returns the quantized model
+    """
+    model = model.cpu().eval()
+    inp_dim = int(model.net_info["height"])
+
+    prepare_int8(model, engine)
+    with torch.no_grad():
+        for batch in calibration_batches(list_file, inp_dim, num_images, batch_size):
+            model(batch)
+
+    return convert(model, inplace=True)
+
+
+def latency(model, batch, runs=10):
+    """Best forward time in seconds over runs"""
+    times = []
+    with torch.no_grad():
+        model(batch)
+        for _ in range(runs):
+            start = time.time()
+            model(batch)
+            times.append(time.time() - start)
+    return min(times)
+
+
+def arg_parse():
+    """
+    Parse arguements to the quantization module
+
+    """
+    parser = argparse.ArgumentParser(description='YOLO v3 int8 quantization report')
+    parser.add_argument("--cfg", dest = 'cfgfile', help = "Config file",
+                        default = "cfg/yolov3-tiny.cfg", type = str)
+    parser.add_argument("--weights", dest = 'weightsfile', help = "Darknet weights or PyTorch state dict",
+                        default = "yolov3-tiny.weights", type = str)
+    parser.add_argument("--calib", dest = "calib", help = "Image list to calibrate on",
+                        default = "data/train.txt", type = str)
+    parser.add_argument("--num_calib", dest = "num_calib", help = "Number of calibration images",
+                        default = 200, type = int)
+    parser.add_argument("--test", dest = "test", help = "Image list to evaluate on, skipped if empty",
+                        default = "data/test.txt", type = str)
+    parser.add_argument("--bs", dest = "bs", help = "Batch size for the latency runs",
+                        default = 1, type = int)
+    parser.add_argument("--engine", dest = "engine", help = "Quantized engine (fbgemm on x86, qnnpack on ARM)",
+                        default = None, type = str)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+
+    float_model = load_model(args.cfgfile, args.weightsfile).eval()
+    int8_model = quantize_darknet(copy.deepcopy(float_model), args.calib, args.num_calib, engine=args.engine)
+
+    inp_dim = int(float_model.net_info["height"])
+    batch = next(calibration_batches(args.calib, inp_dim, args.bs, args.bs))
+
+    float_time = latency(float_model, batch)
+    int8_time = latency(int8_model, batch)
+
+    print("{:10s} {:>12s} {:>10s}".format("model", "latency (ms)", "AP"))
+    results = []
+    for name, model, model_time in [("float", float_model, float_time), ("int8", int8_model, int8_time)]:
+        ap = float("nan")
+        if args.test:
+            from eval import evaluate
+            _, _, ap = evaluate(model, args.test, inp_dim, float_model.num_classes, device=torch.device("cpu"))
+            ap = np.mean(ap)
+        results.append(ap)
+        print("{:10s} {:12.1f} {:10.4f}".format(name, model_time*1000, ap))
+
+    print("Speedup {:.2f}x, AP delta {:+.4f}".format(float_time / int8_time, results[1] - results[0]))
@@ -0,0 +1,150 @@
+"""
+Process-wide cache of the runtime resources the entry points share: class
+names, color palettes, parsed cfgs and loaded models.
+
+Every resource is keyed by the absolute path of the file(s) it was loaded
+from and remembers their modification time and size. A lookup whose files
+changed on disk reloads them. `invalidate` drops entries explicitly.
+
+e.g.
+    classes = get_classes("data/obj.data")      # the names= file of a .data file
+    colors = get_palette()
+    model = get_model("cfg/yolov3-tiny.cfg", "runs/model.pth", device=device)
+
+"""
+
+import copy
+import os
+import pickle as pkl
+import threading
+
+import torch
+
+from darknet import Darknet, parse_cfg
+from util import load_classes
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def file_stamp(path):
+    """(modification time, size) of path, changes when the file is rewritten"""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def cached(kind, paths, load, *key):
+    """
+    Returns load() from the cache, calling it again when any of paths changed
+    since the cached value was loaded
+
+    Arguments
+    ---------
+    kind : str
+        Resource type, part of the key
+
+    paths : list of str
+        Files the resource is loaded from
+
+    key : extra hashable parts of the key (device, flags)
+    """
+    paths = [os.path.abspath(path) for path in paths]
+    full_key = (kind, tuple(paths)) + key
+    stamp = [file_stamp(path) for path in paths]
+
+    with _lock:
+        entry = _cache.get(full_key)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+
+    value = load()
+    with _lock:
+        _cache[full_key] = (stamp, value)
+    return value
+
+
+def invalidate(path=None):
+    """Drops every cached resource loaded from path, or everything if path is None"""
+    with _lock:
+        if path is None:
+            _cache.clear()
+            return
+        path = os.path.abspath(path)
+        for key in [key for key in _cache if path in key[1]]:
+            del _cache[key]
+
+
+def parse_data(datafile):
+    """
+    Key/value pairs of a darknet .data file (classes, train, valid, names, backup)
+    """
+    def load():
+        options = {}
+        with open(datafile, "r") as fp:
+            for line in fp:
+                line = line.strip()
+                if not line or line[0] == "#" or "=" not in line:
+                    continue
+                key, value = line.split("=", 1)
+                options[key.strip()] = value.strip()
+        return options
+    return dict(cached("data", [datafile], load))
+
+
+def get_classes(namesfile):
+    """
+    Class names, one per line of namesfile. A darknet .data file is
+    followed to its names= entry
+    """
+    if namesfile.endswith(".data"):
+        namesfile = parse_data(namesfile)["names"]
+    return cached("classes", [namesfile], lambda: load_classes(namesfile))
+
+
+def get_palette(palettefile="pallete"):
+    """Pickled list of colors to draw boxes with"""
+    def load():
+        with open(palettefile, "rb") as fp:
+            return pkl.load(fp)
+    return cached("palette", [palettefile], load)
+
+
+def get_blocks(cfgfile):
+    """
+    Parsed blocks of a cfg (see darknet.parse_cfg). The caller gets its own
+    copy and may change it
+    """
+    return copy.deepcopy(cached("cfg", [cfgfile], lambda: parse_cfg(cfgfile)))
+
+
+#Extensions of PyTorch state dicts (train.py writes .pth), any other file is
+#read as darknet weights
+STATE_DICT_EXTENSIONS = (".pth", ".pt")
+
+
+def load_model(cfgfile, weightsfile, train=False, device=None):
+    """Uncached model from darknet weights or from a PyTorch state dict (train.py output)"""
+    model = Darknet(None, train=train, blocks=get_blocks(cfgfile))
+    if os.path.splitext(weightsfile)[1].lower() in STATE_DICT_EXTENSIONS:
+        model.load_state_dict(torch.load(weightsfile, map_location="cpu"))
+    else:
+        model.load_weights(weightsfile)
+    if device is not None:
+        model = model.to(device)
+    return model
+
+
+def get_model(cfgfile, weightsfile, device=None, fuse=False):
+    """
+    Model in eval mode on device, shared by every caller asking for the same 
+    cfg, weights, device and fuse flag. Callers must not change it (move it,
+    switch its mode, edit its net_info): the input size comes from the input
+    itself. Use `load_model` for a model of your own (to train it or to 
+    change it)
+    """
+    def load():
+        model = load_model(cfgfile, weightsfile, device=device)
+        if fuse:
+            model.fuse()
+        return model.eval()
+    return cached("model", [cfgfile, weightsfile], load, str(device), fuse)
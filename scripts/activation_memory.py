@@ -0,0 +1,38 @@
+#########################################################
+# activation_memory.py
+#
+# Reports the peak activation memory of an inference
+# pass per cfg and input resolution, from the cfg alone.
+#
+# e.g. python scripts/activation_memory.py \
+#          --cfg cfg/yolov3.cfg cfg/yolov3-tiny.cfg \
+#          --reso 320,416,608
+#########################################################
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from darknet import parse_cfg, activation_memory
+
+# Collect command line arguments
+parser = argparse.ArgumentParser(description='Report peak activation memory.')
+parser.add_argument('--cfg', type=str, nargs='+', default=['cfg/yolov3.cfg'],
+                    help='Config file(s)')
+parser.add_argument('--reso', type=str, default='416',
+                    help='Comma separated input resolutions')
+parser.add_argument('--bs', type=int, default=1,
+                    help='Batch size')
+parser.add_argument('--bytes', type=int, default=4,
+                    help='Bytes per element (4 for float32, 2 for half)')
+args = parser.parse_args()
+
+MB = float(2**20)
+
+print("{:30s} {:>6s} {:>12s} {:>12s}".format("cfg", "reso", "peak (MB)", "keep all (MB)"))
+for cfgfile in args.cfg:
+    blocks = parse_cfg(cfgfile)
+    for reso in [int(x) for x in args.reso.split(',')]:
+        peak, keep_all, _ = activation_memory(blocks, reso, args.bs, args.bytes)
+        print("{:30s} {:6d} {:12.1f} {:12.1f}".format(os.path.basename(cfgfile), reso, peak/MB, keep_all/MB))
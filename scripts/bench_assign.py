@@ -0,0 +1,134 @@
+#########################################################
+# bench_assign.py
+#
+# Times the ground truth to anchor assignment of
+# CustomDataset (best anchor per box) and the background
+# anchors of TargetBuilder against the per box loops
+# they replaced, on synthetic crowded images.
+#
+# e.g. python scripts/bench_assign.py --boxes 150 --inp_dim 608
+#########################################################
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bbox import center_to_corner, bbox_iou
+from customloader import CustomDataset, TargetBuilder
+
+# Collect command line arguments
+parser = argparse.ArgumentParser(description='Benchmark the ground truth assignment.')
+parser.add_argument('--boxes', type=int, default=120,
+                    help='Ground truth boxes per image')
+parser.add_argument('--images', type=int, default=20,
+                    help='Images to assign')
+parser.add_argument('--inp_dim', type=int, default=416,
+                    help='Network input size')
+parser.add_argument('--min_size', type=float, default=8,
+                    help='Smallest box side in pixels')
+parser.add_argument('--max_size', type=float, default=120,
+                    help='Largest box side in pixels')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+
+def loop_predictors(data, ground_truth, label_map):
+    """The per box greedy argmax over the full IoU matrix"""
+    total_boxes_per_gt = sum(data.anchor_nums)
+    num_ground_truth_in_im = ground_truth.shape[0]
+
+    inds = np.zeros((num_ground_truth_in_im, total_boxes_per_gt), dtype = np.int64)
+    for n, anchor in enumerate(data.anchor_nums):
+        offset = sum(data.num_pred_boxes[:n])
+        center_cells = (ground_truth[:,[0,1]]) // data.strides[n]
+        a = offset + data.anchor_nums[n]*(data.inp_dim//data.strides[n]*center_cells[:,1] + center_cells[:,0])
+        for x in range(data.anchor_nums[n]):
+            inds[:,sum(data.anchor_nums[:n]) + x] = a + x
+
+    candidate_boxes = center_to_corner(label_map[inds][:,:,:4]).transpose(0,2,1)
+    ground_truth_boxes = center_to_corner(ground_truth.copy()[np.newaxis]).squeeze(0)[:,:4][:,:,np.newaxis]
+    candidate_ious = bbox_iou(candidate_boxes, ground_truth_boxes, lib="numpy")
+
+    prediction_boxes = np.zeros((num_ground_truth_in_im,1), dtype=np.int64)
+    for i in range(num_ground_truth_in_im):
+        max_iou_ind = np.argmax(candidate_ious)
+        max_iou_row = max_iou_ind // total_boxes_per_gt
+        max_iou_col = max_iou_ind % total_boxes_per_gt
+        prediction_boxes[max_iou_row] = inds[max_iou_row, max_iou_col]
+        box_mask = (inds != max_iou_ind).reshape(-1,len(data.anchors))
+        candidate_ious *= box_mask
+        candidate_ious[max_iou_row] *= 0
+    return prediction_boxes
+
+
+def loop_no_obj(data, ground_truth, label_map, ground_truth_predictors):
+    """IoU of every box with every anchor"""
+    num_ground_truth_in_im = ground_truth.shape[0]
+    inds = np.arange(sum(data.num_pred_boxes))[np.newaxis].repeat(num_ground_truth_in_im, axis = 0)
+
+    candidate_boxes = center_to_corner(label_map[inds][:,:,:4]).transpose(0,2,1)
+    ground_truth_boxes = center_to_corner(ground_truth.copy()[np.newaxis]).squeeze(0)[:,:4][:,:,np.newaxis]
+    candidate_ious = bbox_iou(candidate_boxes, ground_truth_boxes, lib = "numpy")
+    candidate_ious[:, ground_truth_predictors] = 1
+    return np.nonzero(np.max(candidate_ious, 0) < 0.5)[0]
+
+
+def fake_ground_truth(rng):
+    """[centre_x, centre_y, w, h, class] rows of args.boxes boxes inside the image"""
+    wh = rng.uniform(args.min_size, args.max_size, (args.boxes, 2))
+    centres = rng.uniform(wh/2, args.inp_dim - wh/2)
+    return np.concatenate([centres, wh, np.zeros((args.boxes, 1))], 1)
+
+
+def timed(fn, *fn_args):
+    start = time.time()
+    out = fn(*fn_args)
+    return out, time.time() - start
+
+
+with tempfile.NamedTemporaryFile("w", suffix=".txt") as ann_file:
+    data = CustomDataset(root = None, ann_file = ann_file.name)
+data.set_inp_dim(args.inp_dim)
+anchor_boxes, _ = data.get_templates()
+targets = TargetBuilder(data)
+
+
+def background(ground_truth, predictors):
+    """Background anchors of one image from TargetBuilder"""
+    ground_truth = torch.Tensor(np.concatenate([np.zeros((ground_truth.shape[0], 1)), ground_truth, predictors], 1))
+    return np.nonzero(targets.get_background(ground_truth, 1)[0].numpy())[0]
+
+
+rng = np.random.RandomState(args.seed)
+images = [fake_ground_truth(rng) for _ in range(args.images)]
+
+times = {"loop": [0, 0], "vectorized": [0, 0]}
+same_predictors = 0
+same_no_obj = 0
+for ground_truth in images:
+    loop_pred, t = timed(loop_predictors, data, ground_truth, anchor_boxes)
+    times["loop"][0] += t
+    pred, t = timed(data.get_ground_truth_predictors, ground_truth, anchor_boxes)
+    times["vectorized"][0] += t
+
+    # Background anchors of the same predictors, so only the ignore mask differs
+    loop_cands, t = timed(loop_no_obj, data, ground_truth, anchor_boxes, pred)
+    times["loop"][1] += t
+    cands, t = timed(background, ground_truth, pred)
+    times["vectorized"][1] += t
+
+    same_predictors += (loop_pred == pred).sum()
+    same_no_obj += np.array_equal(loop_cands, cands)
+
+print("{} images of {} boxes at {}".format(args.images, args.boxes, args.inp_dim))
+print("{:12s} {:>16s} {:>16s}".format("engine", "assign (ms/img)", "no obj (ms/img)"))
+for engine, (assign, no_obj) in times.items():
+    print("{:12s} {:16.2f} {:16.2f}".format(engine, assign/args.images*1000, no_obj/args.images*1000))
+print("Same anchor      : {} of {} boxes (the loop lets boxes share anchors)".format(same_predictors, args.images*args.boxes))
+print("Same background  : {} of {} images".format(same_no_obj, args.images))
@@ -0,0 +1,81 @@
+#########################################################
+# bench_data.py
+#
+# Images per second of the training data pipeline
+# alone (decoding, augmentation, assignment, collation
+# and optionally the label maps on the device), for a
+# range of loader worker counts.
+#
+# e.g. python scripts/bench_data.py --ann_file data/train.txt --workers 0,2,4 --augment
+#########################################################
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from customloader import CustomDataset, TargetBuilder, training_loader, transforms
+from data_aug.data_aug import Sequence, YoloResize
+
+# Collect command line arguments
+parser = argparse.ArgumentParser(description='Benchmark the training data pipeline.')
+parser.add_argument('--ann_file', type=str, default='data/train.txt',
+                    help='Image list, one path per line with a .txt label next to every image')
+parser.add_argument('--bs', type=int, default=8,
+                    help='Images per batch')
+parser.add_argument('--batches', type=int, default=50,
+                    help='Batches timed per setting (after one warm up batch)')
+parser.add_argument('--workers', type=str, default='0,2,4',
+                    help='Comma separated worker counts')
+parser.add_argument('--prefetch_factor', type=int, default=2,
+                    help='Batches loaded ahead by every worker')
+parser.add_argument('--pin_memory', action='store_true',
+                    help='Collate into pinned memory')
+parser.add_argument('--augment', action='store_true',
+                    help='Use the full augmentation of customloader instead of the resize only')
+parser.add_argument('--targets', action='store_true',
+                    help='Also build the label maps on the device')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+det_transforms = transforms if args.augment else Sequence([YoloResize(416)])
+data = CustomDataset(root = "data", ann_file = args.ann_file, det_transforms = det_transforms)
+targets = TargetBuilder(data)
+
+
+def batches(loader):
+    """Endless batches, new epochs start on the same persistent workers"""
+    while True:
+        for batch in loader:
+            yield batch
+
+
+print("{} images, batches of {} on {}".format(len(data), args.bs, device))
+print("{:>8s} {:>12s} {:>12s}".format("workers", "images/s", "ms/batch"))
+for workers in [int(x) for x in args.workers.split(',')]:
+    loader = training_loader(data, args.bs, num_workers = workers, persistent_workers = True,
+                             prefetch_factor = args.prefetch_factor, pin_memory = args.pin_memory,
+                             shuffle = True, seed = args.seed)
+    stream = batches(loader)
+    next(stream)
+
+    images = 0
+    start = time.time()
+    for _ in range(args.batches):
+        image, ground_truth = next(stream)
+        image = image.to(device, non_blocking = args.pin_memory)
+        ground_truth = ground_truth.to(device, non_blocking = args.pin_memory)
+        if args.targets:
+            targets(ground_truth, image.size(0))
+        images += image.size(0)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    secs = time.time() - start
+
+    print("{:8d} {:12.1f} {:12.2f}".format(workers, images/secs, secs/args.batches*1000))
+    del stream, loader
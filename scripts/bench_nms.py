@@ -0,0 +1,67 @@
+#########################################################
+# bench_nms.py
+#
+# Times the per-class loop NMS in util.write_results
+# against the batched NMS engine on synthetic crowded
+# frames.
+#
+# e.g. python scripts/bench_nms.py --bs 4 --boxes 2000
+#########################################################
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import write_results
+
+# Collect command line arguments
+parser = argparse.ArgumentParser(description='Benchmark the NMS engines.')
+parser.add_argument('--bs', type=int, default=4,
+                    help='Images per batch')
+parser.add_argument('--anchors', type=int, default=10647,
+                    help='Predicted boxes per image (10647 for yolov3 at 416)')
+parser.add_argument('--boxes', type=int, default=1000,
+                    help='Boxes per image above the confidence threshold')
+parser.add_argument('--classes', type=int, default=80,
+                    help='Number of classes')
+parser.add_argument('--inp_dim', type=int, default=416,
+                    help='Network input size')
+parser.add_argument('--runs', type=int, default=10,
+                    help='Timed runs per engine')
+args = parser.parse_args()
+
+
+def fake_prediction():
+    """Random B x anchors x (5 + classes) prediction where `args.boxes`
+    boxes per image clear a 0.5 confidence threshold"""
+    prediction = torch.rand(args.bs, args.anchors, 5 + args.classes)
+    prediction[:,:,:2] *= args.inp_dim
+    prediction[:,:,2:4] = prediction[:,:,2:4]*args.inp_dim/4 + 4
+    prediction[:,:,4] *= 0.5
+    for b in range(args.bs):
+        hits = torch.randperm(args.anchors)[:args.boxes]
+        prediction[b, hits, 4] += 0.5
+    return prediction
+
+
+def time_engine(prediction, engine):
+    times = []
+    for _ in range(args.runs):
+        # write_results modifies its input
+        pred = prediction.clone()
+        start = time.time()
+        output = write_results(pred, 0.5, args.classes, nms=True, nms_conf=0.4, engine=engine)
+        times.append(time.time() - start)
+    num_dets = 0 if type(output) == int else output.size(0)
+    return min(times), sum(times)/len(times), num_dets
+
+
+prediction = fake_prediction()
+print("{:10s} {:>10s} {:>10s} {:>10s}".format("engine", "best (ms)", "mean (ms)", "dets"))
+for engine in ["loop", "batched"]:
+    best, mean, num_dets = time_engine(prediction, engine)
+    print("{:10s} {:10.2f} {:10.2f} {:10d}".format(engine, best*1000, mean*1000, num_dets))
@@ -0,0 +1,66 @@
+#########################################################
+# bench_startup.py
+#
+# Compares model startup time of cfg + darknet weights
+# (parse_cfg, create_modules, load_weights) against
+# loading a compiled model (see compiled.py).
+#
+# e.g. python scripts/bench_startup.py --cfg cfg/yolov3.cfg \
+#          --weights yolov3.weights --compiled yolov3.dkn
+#########################################################
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from darknet import Darknet
+from compiled import save_compiled, load_compiled
+
+# Collect command line arguments
+parser = argparse.ArgumentParser(description='Benchmark model startup.')
+parser.add_argument('--cfg', type=str, default='cfg/yolov3.cfg',
+                    help='Config file')
+parser.add_argument('--weights', type=str, default='yolov3.weights',
+                    help='Darknet weights file')
+parser.add_argument('--compiled', type=str, default='yolov3.dkn',
+                    help='Compiled model, written from cfg and weights if missing')
+parser.add_argument('--runs', type=int, default=5,
+                    help='Timed runs per path')
+args = parser.parse_args()
+
+
+def cfg_startup(mmap):
+    model = Darknet(args.cfg, train=False)
+    model.load_weights(args.weights, mmap=mmap)
+    return model
+
+
+def compiled_startup():
+    return load_compiled(args.compiled)
+
+
+def time_startup(startup):
+    times = []
+    for _ in range(args.runs):
+        start = time.time()
+        # create_modules prints the net block
+        with contextlib.redirect_stdout(io.StringIO()):
+            startup()
+        times.append(time.time() - start)
+    return min(times), sum(times)/len(times)
+
+
+if not os.path.exists(args.compiled):
+    with contextlib.redirect_stdout(io.StringIO()):
+        save_compiled(cfg_startup(True), args.compiled)
+
+print("{:25s} {:>10s} {:>10s}".format("path", "best (ms)", "mean (ms)"))
+for name, startup in [("cfg + weights", lambda: cfg_startup(False)),
+                      ("cfg + weights (mmap)", lambda: cfg_startup(True)),
+                      ("compiled", compiled_startup)]:
+    best, mean = time_startup(startup)
+    print("{:25s} {:10.1f} {:10.1f}".format(name, best*1000, mean*1000))
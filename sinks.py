@@ -0,0 +1,246 @@
+"""
+Columnar detection output for batch jobs.
+
+A sink receives the detections of every batch in bulk and writes one row
+per box with the columns
+
+    image_id, image, x1, y1, x2, y2, objectness, class, score
+
+where image_id is the index of the image in the job's image list, the box
+is in original image pixels, class the class index and score the class
+confidence. The format follows the file extension:
+
+    .csv      text, one line per box
+    .npz      numpy arrays, one per column (np.load(path)["x1"], ...)
+    .parquet  Apache Parquet, one row group per flush (needs pyarrow)
+
+Sharded jobs (detect.py --workers) write one part per worker and merge
+them in order with `merge_parts`.
+"""
+
+import abc
+import csv
+import os
+
+import numpy as np
+
+COLUMNS = ["image_id", "image", "x1", "y1", "x2", "y2", "objectness", "class", "score"]
+
+#Decimals of the float columns in text output
+CSV_DECIMALS = {"x1": 2, "y1": 2, "x2": 2, "y2": 2, "objectness": 4, "score": 4}
+
+
+def detection_columns(prediction, batch_imlist, image_ids):
+    """
+    Columns of a batch of detections
+
+    Arguments
+    ---------
+    prediction : tensor (2D)
+        [batch_index, x1, y1, x2, y2, objectness, class_confidence, class_index]
+
+    batch_imlist : list
+        Path of every image of the batch
+
+    image_ids : list
+        Job wide index of every image of the batch
+    """
+    prediction = prediction.detach().cpu().numpy()
+    batch_index = prediction[:,0].astype(np.int64)
+    return {"image_id": np.asarray(image_ids, dtype=np.int64)[batch_index],
+            "image": np.asarray(batch_imlist, dtype=object)[batch_index],
+            "x1": prediction[:,1].astype(np.float32),
+            "y1": prediction[:,2].astype(np.float32),
+            "x2": prediction[:,3].astype(np.float32),
+            "y2": prediction[:,4].astype(np.float32),
+            "objectness": prediction[:,5].astype(np.float32),
+            "class": prediction[:,7].astype(np.int32),
+            "score": prediction[:,6].astype(np.float32)}
+
+
+class DetectionSink(abc.ABC):
+    """
+    Buffers detection columns and writes them in chunks of at least
+    flush_rows rows. Formats implement `flush`
+    """
+    def __init__(self, path, flush_rows=65536):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.chunks = []
+        self.buffered = 0
+        self.rows = 0
+
+    def write(self, prediction, batch_imlist, image_ids):
+        """Adds the detections of a batch, see `detection_columns`"""
+        if type(prediction) == int or prediction.size(0) == 0:
+            return
+        columns = detection_columns(prediction, batch_imlist, image_ids)
+        self.chunks.append(columns)
+        self.buffered += len(columns["x1"])
+        self.rows += len(columns["x1"])
+        if self.buffered >= self.flush_rows:
+            self.flush()
+
+    def take(self):
+        """The buffered rows as one array per column, emptying the buffer"""
+        if not self.chunks:
+            return None
+        columns = {name: np.concatenate([chunk[name] for chunk in self.chunks]) for name in COLUMNS}
+        self.chunks = []
+        self.buffered = 0
+        return columns
+
+    @abc.abstractmethod
+    def flush(self):
+        """Writes the buffered rows (see `take`)"""
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvSink(DetectionSink):
+    """Quotes the image paths that need it (commas, quotes, line breaks)"""
+    def __init__(self, path, flush_rows=65536):
+        super(CsvSink, self).__init__(path, flush_rows)
+        self.fp = open(path, "w", newline="")
+        self.writer = csv.writer(self.fp, lineterminator="\n")
+        self.writer.writerow(COLUMNS)
+
+    def flush(self):
+        columns = self.take()
+        if columns is None:
+            return
+        for name, decimals in CSV_DECIMALS.items():
+            columns[name] = np.char.mod("%.{}f".format(decimals), columns[name])
+        self.writer.writerows(zip(*[columns[name] for name in COLUMNS]))
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+    @staticmethod
+    def merge(parts, path):
+        #The parts are valid csv, their rows are copied as they are
+        with open(path, "w", newline="") as out:
+            out.write(",".join(COLUMNS) + "\n")
+            for part in parts:
+                with open(part, "r", newline="") as fp:
+                    next(fp)
+                    for line in fp:
+                        out.write(line)
+
+
+class NpzSink(DetectionSink):
+    """Keeps the columns in memory and writes the archive on close"""
+    def __init__(self, path, flush_rows=65536):
+        super(NpzSink, self).__init__(path, flush_rows)
+        self.written = []
+
+    def flush(self):
+        columns = self.take()
+        if columns is not None:
+            self.written.append(columns)
+
+    def close(self):
+        self.flush()
+        NpzSink.save(self.path, self.written)
+
+    @staticmethod
+    def save(path, chunks):
+        columns = {}
+        for name in COLUMNS:
+            arrays = [chunk[name] for chunk in chunks]
+            columns[name] = np.concatenate(arrays) if arrays else np.zeros(0)
+        #Paths as fixed width unicode, object arrays would need pickle to load
+        columns["image"] = columns["image"].astype(str)
+        with open(path, "wb") as fp:
+            np.savez(fp, **columns)
+
+    @staticmethod
+    def merge(parts, path):
+        chunks = []
+        for part in parts:
+            with np.load(part) as data:
+                chunks.append({name: data[name] for name in COLUMNS})
+        NpzSink.save(path, chunks)
+
+
+class ParquetSink(DetectionSink):
+    """Streams one parquet row group per flush"""
+    def __init__(self, path, flush_rows=65536):
+        super(ParquetSink, self).__init__(path, flush_rows)
+        pa, pq = import_pyarrow()
+        self.pa = pa
+        self.schema = pa.schema([("image_id", pa.int64()), ("image", pa.string()),
+                                 ("x1", pa.float32()), ("y1", pa.float32()),
+                                 ("x2", pa.float32()), ("y2", pa.float32()),
+                                 ("objectness", pa.float32()), ("class", pa.int32()),
+                                 ("score", pa.float32())])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def flush(self):
+        columns = self.take()
+        if columns is None:
+            return
+        table = self.pa.Table.from_arrays([self.pa.array(columns[name], type=self.schema.field(name).type)
+                                           for name in COLUMNS], schema=self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    @staticmethod
+    def merge(parts, path):
+        pa, pq = import_pyarrow()
+        writer = None
+        for part in parts:
+            table = pq.read_table(part)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Writing parquet needs pyarrow (pip install pyarrow)")
+    return pyarrow, pyarrow.parquet
+
+
+SINKS = {".csv": CsvSink, ".npz": NpzSink, ".parquet": ParquetSink}
+
+
+def sink_type(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in SINKS:
+        raise ValueError("Unknown detections format {}, use one of {}".format(ext, sorted(SINKS)))
+    return SINKS[ext]
+
+
+def open_sink(path, flush_rows=65536):
+    """Sink writing path, in the format of its extension"""
+    return sink_type(path)(path, flush_rows)
+
+
+def merge_parts(parts, path):
+    """Merges the part files of a sharded job, in order, into path and removes them"""
+    sink_type(path).merge(parts, path)
+    remove_parts(parts)
+
+
+def remove_parts(parts):
+    """Removes the part files that exist, e.g. those of a failed sharded job"""
+    for part in parts:
+        if os.path.exists(part):
+            os.remove(part)
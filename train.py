@@ -20,7 +20,7 @@ import pickle as pkl
 import matplotlib.pyplot as plt
 from bbox import bbox_iou, corner_to_center, center_to_corner
 import pickle 
-from customloader import transforms, CustomDataset
+from customloader import transforms, CustomDataset, training_loader, TargetBuilder
 import torch.optim as optim
 import torch.autograd.gradcheck
 from tensorboardX import SummaryWriter
@@ -29,8 +29,6 @@ import sys
 
 writer = SummaryWriter()
 
-random.seed(0)
-
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 def arg_parse():
@@ -56,6 +54,18 @@ def arg_parse():
     parser.add_argument("--wd", dest = "wd", type = float, default = 0)
     parser.add_argument("--unfreeze", dest = "unfreeze", type = int, default = 4,
                         help="Last number of layers to unfreeze for training")
+    parser.add_argument("--workers", dest = "workers", type = int, default = None,
+                        help="DataLoader processes decoding, augmenting and assigning (workers= of the [net] cfg block, 0 by default)")
+    parser.add_argument("--persistent_workers", dest = "persistent_workers", action = "store_true",
+                        help="Keep the loader processes alive between epochs")
+    parser.add_argument("--prefetch_factor", dest = "prefetch_factor", type = int, default = 2,
+                        help="Batches loaded ahead by every worker")
+    parser.add_argument("--pin_memory", dest = "pin_memory", action = "store_true",
+                        help="Collate batches into pinned memory for faster copies to the GPU")
+    parser.add_argument("--shuffle", dest = "shuffle", action = "store_true",
+                        help="Shuffle the training images")
+    parser.add_argument("--seed", dest = "seed", type = int, default = 0,
+                        help="Seed of the augmentations (per worker) and of the shuffling")
 
 
     return parser.parse_args()
@@ -63,6 +73,10 @@ def arg_parse():
 
 args = arg_parse()
 
+random.seed(args.seed)
+np.random.seed(args.seed)
+torch.manual_seed(args.seed)
+
 #Load the model
 model = Darknet(args.cfgfile, train=True)
 
@@ -131,7 +145,12 @@ transforms = Sequence([YoloResize(inp_dim)])
 
 data = CustomDataset(root = "data", ann_file="data/train.txt", det_transforms=transforms)
 
-data_loader = DataLoader(data, batch_size=bs)
+workers = args.workers if args.workers is not None else int(net_options.get('workers', 0))
+data_loader = training_loader(data, bs, num_workers=workers, persistent_workers=args.persistent_workers,
+                              prefetch_factor=args.prefetch_factor, pin_memory=args.pin_memory,
+                              shuffle=args.shuffle, seed=args.seed)
+#Label maps are built from the sparse ground truth on the training device
+targets = TargetBuilder(data)
 optimizer = optim.SGD(model.parameters(), lr=lr, momentum=momentum, weight_decay=wd)
 
 def logloss(pred, target):
@@ -184,8 +203,11 @@ def YOLO_loss(ground_truth, output):
 
     total_loss = 0
     
-    #get the objectness loss
-    loss_inds = torch.nonzero(ground_truth[:,:,-4] > -1)
+    #get the objectness loss, over the predicting (1) and background (0) 
+    #anchors of every image, the ignored ones (-1) are left out. The 
+    #objectness of the output is a logit while training, so this is a 
+    #logistic loss, summed like the box and class terms
+    loss_inds = torch.nonzero(ground_truth[:,:,4] > -1)
     
     
     objectness_pred = output[loss_inds[:,0],loss_inds[:,1],4]
@@ -193,11 +215,13 @@ def YOLO_loss(ground_truth, output):
     target = ground_truth[loss_inds[:,0],loss_inds[:,1],4]
     
     
-    objectness_loss = torch.nn.MSELoss(size_average=False)(objectness_pred, target)
+    objectness_loss = torch.nn.BCEWithLogitsLoss(reduction="sum")(objectness_pred, target)
     
     
     
-    print("Obj Loss", objectness_loss)
+    print("Obj Loss", float(objectness_loss))
+    
+    total_loss += objectness_loss
 
     
     
@@ -266,16 +290,12 @@ itern = 0
 epochs = int(len(data) / bs)
 unfreeze_step = 0.8 * len(data)
 for image, ground_truth in data_loader:
-    print('ID ', data.examples[itern])
-    if len(ground_truth) == 0:
-        continue
-
     # # Track gradients in backprop
     # image = torch.tensor(image, requires_grad=True).to(device)
     # ground_truth = torch.tensor(ground_truth, requires_grad=True).to(device)
     # with torch.no_grad():
-    image = image.to(device)
-    ground_truth = ground_truth.to(device)
+    image = image.to(device, non_blocking=args.pin_memory)
+    ground_truth = targets(ground_truth.to(device, non_blocking=args.pin_memory), image.size(0))
     
     output = model(image)
 
@@ -311,7 +331,7 @@ for image, ground_truth in data_loader:
         # param_group["lr"] /= bs
     
     print('lr: ', optimizer.param_groups[0]["lr"])
-    if loss:
+    if loss is not None:
         print("Loss for iter no: {}: {}".format(itern, float(loss)/bs))
         writer.add_scalar("Loss/vanilla", float(loss), itern)
         loss.backward()
@@ -0,0 +1,129 @@
+"""
+Test-time augmentation for Darknet.
+
+Every augmented view (a horizontal flip and/or a downscale of the
+letterboxed input, padded back to the network size like the letterbox
+does) is built on the device from the batch itself. All views go through
+the network stacked in one forward, their boxes are mapped back to the
+input with the inverse transforms, and the views of an image are merged
+with weighted box fusion or NMS. Only the max_boxes most confident boxes
+of every view go into the merge.
+
+e.g.
+    output = model.tta(batch, confidence=0.5, nms_conf=0.4,
+                       scales=(1.0, 0.83, 0.67), flips=(False, True))
+"""
+
+from __future__ import division
+
+import torch
+import torch.nn.functional as F
+
+from util import write_results_batched, weighted_box_fusion
+
+#Grey of the letterbox padding
+PAD_VALUE = 128/255.0
+
+
+def tta_views(scales=(1.0,), flips=(False, True)):
+    """(scale, flip) of every view"""
+    for scale in scales:
+        if not 0 < scale <= 1:
+            raise ValueError("TTA scales must be in (0, 1], got {}".format(scale))
+    return [(scale, flip) for scale in scales for flip in flips]
+
+
+def view_size(inp_dim, scale):
+    return max(1, int(round(inp_dim*scale)))
+
+
+def augment(x, scale, flip):
+    """
+    A view of a batch of (letterboxed) inputs: mirrored when flip, the
+    image shrunk by scale and centred on a padded canvas of the same size
+    """
+    if flip:
+        x = x.flip(3)
+    if scale == 1:
+        return x
+
+    inp_dim = x.size(2)
+    size = view_size(inp_dim, scale)
+    offset = (inp_dim - size)//2
+    view = x.new_full(x.shape, PAD_VALUE)
+    view[:,:,offset:offset + size,offset:offset + size] = F.interpolate(x, size=(size, size),
+                                                                        mode="bilinear", align_corners=False)
+    return view
+
+
+def invert(prediction, scale, flip, inp_dim):
+    """
+    Maps the [centre_x, centre_y, w, h, ...] detections of a view back to
+    the input, in place
+    """
+    if scale != 1:
+        size = view_size(inp_dim, scale)
+        offset = (inp_dim - size)//2
+        factor = size/inp_dim
+        prediction[...,0:2] -= offset
+        prediction[...,0:4] /= factor
+    if flip:
+        prediction[...,0] = inp_dim - prediction[...,0]
+    return prediction
+
+
+def detect_tta(model, x, confidence, nms_conf=0.4, scales=(1.0,), flips=(False, True),
+               merge="wbf", heads=None, max_boxes=1000):
+    """
+    Detections of a batch merged over its augmented views
+
+    Arguments
+    ---------
+    model : Darknet
+        In eval mode
+
+    x : tensor (4D)
+        Letterboxed batch, B x 3 x inp_dim x inp_dim
+
+    merge : str
+        "wbf" fuses the boxes of all views (see `util.weighted_box_fusion`),
+        "nms" keeps the best box of every cluster
+
+    max_boxes : int or None
+        boxes of every view of an image (the highest objectness) merged, 
+        which bounds the cost of the merge at low confidence thresholds. 
+        None merges them all
+
+    Returns
+    -------
+    output : tensor (2D) or 0 if nothing is detected
+        [batch_index, x1, y1, x2, y2, objectness, class_confidence, class_index]
+    """
+    if merge not in ("wbf", "nms"):
+        raise ValueError("Unknown TTA merge {}, use wbf or nms".format(merge))
+
+    views = tta_views(scales, flips)
+    batch_size, inp_dim = x.size(0), x.size(2)
+
+    with torch.no_grad():
+        prediction = model(torch.cat([augment(x, scale, flip) for scale, flip in views]), heads=heads)
+    if type(prediction) == int:
+        return 0
+
+    for v, (scale, flip) in enumerate(views):
+        invert(prediction[v*batch_size:(v + 1)*batch_size], scale, flip, inp_dim)
+
+    if max_boxes is not None and max_boxes < prediction.size(1):
+        top = torch.topk(prediction[:,:,4], max_boxes, dim=1)[1]
+        prediction = torch.gather(prediction, 1, top.unsqueeze(2).expand(-1, -1, prediction.size(2)))
+
+    #Every image gets the boxes of all its views
+    num_boxes, bbox_attrs = prediction.size(1), prediction.size(2)
+    prediction = prediction.view(len(views), batch_size, num_boxes, bbox_attrs).transpose(0, 1)
+    prediction = prediction.reshape(batch_size, len(views)*num_boxes, bbox_attrs)
+
+    if merge == "nms":
+        return write_results_batched(prediction, confidence, model.num_classes, nms=True, nms_conf=nms_conf)
+
+    output = write_results_batched(prediction, confidence, model.num_classes, nms=False)
+    return weighted_box_fusion(output, nms_conf, len(views))
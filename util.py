@@ -1,5 +1,6 @@
 
 from __future__ import division
+import math
 import random
 import torch 
 import torch.nn as nn
@@ -25,12 +26,52 @@ def convert2cpu(matrix):
     else:
         return matrix
 
-def predict_transform(prediction, inp_dim, anchors, num_classes, train=False, height=416, width=416):
+def make_offsets(grid_size, stride, anchors, device, dtype=torch.float32):
+    """
+    Builds the tensors a YOLO head adds to its raw output, in pixels
+
+    Returns
+    -------
+    x_y_offset : tensor (4D)
+        1 x (grid_size*grid_size) x num_anchors x 2 top left corners of the cells
+    anchors : tensor (4D)
+        1 x (grid_size*grid_size) x num_anchors x 2 anchor sizes
+    """
+    num_anchors = len(anchors)
+
+    grid_len = np.arange(grid_size)
+    a,b = np.meshgrid(grid_len, grid_len)
+    x_offset = torch.FloatTensor(a).view(-1,1)
+    y_offset = torch.FloatTensor(b).view(-1,1)
+    x_y_offset = torch.cat((x_offset, y_offset), 1).repeat(1,num_anchors).view(1,-1,num_anchors,2)*stride
+
+    anchors = torch.FloatTensor(anchors)
+    anchors = anchors.repeat(grid_size*grid_size, 1).view(1,-1,num_anchors,2)
+
+    return x_y_offset.to(device=device, dtype=dtype), anchors.to(device=device, dtype=dtype)
+
+def predict_transform(prediction, inp_dim, anchors, num_classes, train=False, height=416, width=416, offsets=None, out=None):
     """
     Arguments
     ---------
+    prediction : tensor (4D)
+        raw output of the conv layer before a yolo layer, 
+        batch x (num_anchors*bbox_attrs) x grid_size x grid_size
+
+    offsets : tuple of tensors
+        (x_y_offset, anchors) as returned by `make_offsets`, built on the fly
+        if not given
+
+    out : tensor (3D)
+        batch x (grid_size*grid_size*num_anchors) x bbox_attrs buffer to decode 
+        into, e.g. this head's slice of the detections of all heads. Allocated
+        if not given
+
+    Returns
+    -------
     prediction : tensor (3D)
-        [centre_x, centre_y, box_height, box_width, mask_confidence, class_confidence]
+        [centre_x, centre_y, box_width, box_height, objectness, class_confidence...]
+        raw (not decoded) when training
     """
 
     batch_size = prediction.size(0)
@@ -38,50 +79,83 @@ def predict_transform(prediction, inp_dim, anchors, num_classes, train=False, he
     grid_size = inp_dim // stride
     bbox_attrs = 5 + num_classes
     num_anchors = len(anchors)
-    h = prediction.size(2)
-    w = prediction.size(3)
-    print('h w ', h, w)
-    
-    anchors = [(a[0]/stride, a[1]/stride) for a in anchors]
 
-    # prediction = prediction.view(int(batch_size*num_anchors), 
-    #     int(5+num_classes), int(h*w)).transpose(0,1).contiguous().view(5+num_classes, 
-    #     batch_size*num_anchors*h*w)
-
-    prediction = prediction.view(batch_size, bbox_attrs*num_anchors, grid_size*grid_size)
-    prediction = prediction.transpose(1,2).contiguous()
-    prediction = prediction.view(batch_size, grid_size*grid_size*num_anchors, bbox_attrs)
+    #B x (A*attrs) x G x G --> B x (G*G) x A x attrs, a strided view, nothing is copied
+    raw = prediction.view(batch_size, bbox_attrs*num_anchors, grid_size*grid_size).transpose(1,2)
 
     if train:
-        return prediction
+        return raw.contiguous().view(batch_size, grid_size*grid_size*num_anchors, bbox_attrs)
+
+    raw = raw.view(batch_size, grid_size*grid_size, num_anchors, bbox_attrs)
+
+    if offsets is None:
+        offsets = make_offsets(grid_size, stride, anchors, prediction.device, prediction.dtype)
+    x_y_offset, anchors = offsets
+
+    if out is None:
+        out = prediction.new_empty(batch_size, grid_size*grid_size*num_anchors, bbox_attrs)
+    decoded = out.view(batch_size, grid_size*grid_size, num_anchors, bbox_attrs)
+
+    #Sigmoid the centre x, centre y, objectness and class scores in one pass
+    torch.sigmoid(raw, out=decoded)
 
-    #Sigmoid the  centre_X, centre_Y. and object confidencce
-    prediction[:,:,0] = torch.sigmoid(prediction[:,:,0])
-    prediction[:,:,1] = torch.sigmoid(prediction[:,:,1])
-    prediction[:,:,4] = torch.sigmoid(prediction[:,:,4])
-    
-    #Add the center offsets
-    grid_len = np.arange(grid_size)
-    a,b = np.meshgrid(grid_len, grid_len)
-    x_offset = torch.FloatTensor(a).view(-1,1).to(device)
-    y_offset = torch.FloatTensor(b).view(-1,1).to(device)
-    x_y_offset = torch.cat((x_offset, y_offset), 1).repeat(1,num_anchors).view(-1,2).unsqueeze(0)
-    prediction[:,:,:2] += x_y_offset
-      
     #log space transform height and the width
-    anchors = torch.FloatTensor(anchors).to(device)
-    anchors = anchors.repeat(grid_size*grid_size, 1).unsqueeze(0)
-    prediction[:,:,2:4] = torch.exp(prediction[:,:,2:4])*anchors
+    torch.exp(raw[:,:,:,2:4], out=decoded[:,:,:,2:4])
+    decoded[:,:,:,2:4] *= anchors
 
-    #Softmax the class scores
-    prediction[:,:,5:(5 + num_classes)] = torch.sigmoid((prediction[:,:, 5:(5 + num_classes)]))
+    #Add the center offsets, everything in pixels
+    decoded[:,:,:,:2] *= stride
+    decoded[:,:,:,:2] += x_y_offset
 
-    # scale x_center, y_center, width, height
-    prediction[:,:,:4] *= stride
+    return out
 
-    print('prediction ', prediction)
+def predict_transform_sparse(prediction, inp_dim, anchors, num_classes, confidence, offsets=None):
+    """
+    Like `predict_transform` but only the anchors whose objectness clears
+    confidence are decoded
 
-    return prediction
+    Returns
+    -------
+    detections : tensor (2D)
+        [batch_index, centre_x, centre_y, box_width, box_height, objectness, class_confidence...]
+        one row per surviving anchor
+    """
+    batch_size = prediction.size(0)
+    stride =  inp_dim // prediction.size(2)
+    grid_size = inp_dim // stride
+    bbox_attrs = 5 + num_classes
+    num_anchors = len(anchors)
+
+    raw = prediction.view(batch_size, bbox_attrs*num_anchors, grid_size*grid_size).transpose(1,2)
+    raw = raw.view(batch_size, grid_size*grid_size, num_anchors, bbox_attrs)
+
+    if offsets is None:
+        offsets = make_offsets(grid_size, stride, anchors, prediction.device, prediction.dtype)
+    x_y_offset, anchors = offsets
+
+    #sigmoid(x) > confidence <=> x > logit(confidence), so the threshold is
+    #applied to the raw objectness without a sigmoid over every anchor
+    if confidence <= 0:
+        threshold = -float("inf")
+    elif confidence >= 1:
+        threshold = float("inf")
+    else:
+        threshold = math.log(confidence / (1 - confidence))
+
+    ind = torch.nonzero(raw[:,:,:,4] > threshold)
+    rows = raw[ind[:,0], ind[:,1], ind[:,2]]
+
+    detections = rows.new_empty(rows.size(0), 1 + bbox_attrs)
+    detections[:,0] = ind[:,0]
+    decoded = detections[:,1:]
+
+    torch.sigmoid(rows, out=decoded)
+    torch.exp(rows[:,2:4], out=decoded[:,2:4])
+    decoded[:,2:4] *= anchors[0, ind[:,1], ind[:,2]]
+    decoded[:,:2] *= stride
+    decoded[:,:2] += x_y_offset[0, ind[:,1], ind[:,2]]
+
+    return detections
 
 def load_classes(namesfile):
     fp = open(namesfile, "r")
@@ -102,7 +176,27 @@ def unique(tensor):
     tensor_res.copy_(unique_tensor)
     return tensor_res
 
-def write_results(prediction, confidence, num_classes, nms=True, nms_conf=0.5):
+def write_results(prediction, confidence, num_classes, nms=True, nms_conf=0.5, engine="loop"):
+    """
+    Arguments
+    ---------
+    prediction : tensor (3D)
+        [centre_x, centre_y, box_width, box_height, objectness, class_confidence...]
+
+    engine : str
+        "loop" runs NMS per image and per class, "batched" hands the whole 
+        batch to `write_results_batched`
+
+    Returns
+    -------
+    output : tensor (2D)
+        [batch_index, x1, y1, x2, y2, objectness, class_confidence, class_index]
+    """
+    if engine == "batched":
+        return write_results_batched(prediction, confidence, num_classes, nms=nms, nms_conf=nms_conf)
+    elif engine != "loop":
+        raise ValueError("Unknown NMS engine {}".format(engine))
+
     conf_mask = (prediction[:,:,4] > confidence).float().unsqueeze(2)
     prediction = prediction*conf_mask
     
@@ -198,6 +292,285 @@ def write_results(prediction, confidence, num_classes, nms=True, nms_conf=0.5):
     
     return output
 
+def group_order(scores, groups):
+    """
+    Indices that sort boxes by group and, within each group, by descending score
+    """
+    order = torch.sort(scores, descending=True)[1]
+    return order[torch.sort(groups[order], stable=True)[1]]
+
+def overlapping_pairs(boxes, groups, iou_thresh, max_pairs=1 << 18):
+    """
+    Pairs of boxes of the same group that overlap by iou_thresh or more
+
+    Each group is shifted to its own stretch of the x axis and the boxes are
+    swept in order of x1, so only boxes whose x ranges meet are compared. 
+    Those candidate pairs are built and filtered max_pairs at a time, which 
+    bounds the memory. Their number, and so the time, can still grow with 
+    the square of the number of boxes in one crowded group
+
+    Arguments
+    ---------
+    boxes : tensor (2D)
+        [x1, y1, x2, y2] for every box
+
+    groups : tensor (1D)
+        integer id per box
+
+    max_pairs : int
+        candidate pairs compared at once (a box with more is done on its own)
+
+    Returns
+    -------
+    pairs : tensor (2D)
+        (i, j) indices into boxes with i < j
+    """
+    num_boxes = boxes.size(0)
+    if num_boxes < 2:
+        return torch.zeros(0, 2, dtype=torch.long, device=boxes.device)
+
+    #In double precision so the shift keeps the coordinates exact enough.
+    #bbox_iou counts pixels inclusively, boxes a pixel apart still overlap
+    x1 = boxes[:,0].double()
+    x2 = boxes[:,2].double()
+    span = float((x2.max() - x1.min()).item()) + 2
+    shift = groups.double()*span - x1.min()
+    x1 = x1 + shift
+    x2 = x2 + shift + 1
+
+    x1, by_x1 = torch.sort(x1)
+    x2 = x2[by_x1]
+
+    #Every box is paired with the boxes after it (in x1 order) starting
+    #before it ends
+    ends = torch.searchsorted(x1, x2, right=True)
+    counts = torch.clamp(ends - torch.arange(1, num_boxes + 1, device=boxes.device), min=0)
+    totals = torch.cumsum(counts, 0)
+
+    found = []
+    start = 0
+    while start < num_boxes:
+        #The run of boxes from start whose pairs fit in max_pairs
+        before = int(totals[start - 1]) if start > 0 else 0
+        end = max(int(torch.searchsorted(totals, before + max_pairs, right=True)), start + 1)
+        run_counts = counts[start:end]
+
+        first = torch.repeat_interleave(torch.arange(start, end, device=boxes.device), run_counts)
+        step = torch.arange(first.size(0), device=boxes.device) - torch.repeat_interleave(totals[start:end] - before - run_counts, run_counts)
+        second = first + 1 + step
+        start = end
+
+        first, second = by_x1[first], by_x1[second]
+        same = groups[first] == groups[second]
+        first, second = first[same], second[same]
+
+        ious = bbox_iou(boxes[first], boxes[second])
+        overlap = ious >= iou_thresh
+        first, second = first[overlap], second[overlap]
+        found.append(torch.stack([torch.min(first, second), torch.max(first, second)], 1))
+    return torch.cat(found)
+
+def greedy_keep(pairs, num_boxes):
+    """
+    Boxes greedy NMS keeps, given the suppressing pairs (i, j) of boxes
+    ranked i above j (see `overlapping_pairs`)
+    """
+    #Greedy NMS keeps a box iff no kept box ranked above it suppresses it.
+    #Iterating that rule from "keep everything" settles at least one more rank
+    #every pass, so this reaches the greedy result in (longest suppression chain) passes
+    keep = torch.ones(num_boxes, dtype=torch.bool, device=pairs.device)
+    while True:
+        new_keep = torch.ones_like(keep)
+        new_keep[pairs[:,1][keep[pairs[:,0]]]] = False
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return keep
+
+def batched_nms(boxes, scores, groups, nms_conf=0.5):
+    """
+    Greedy NMS over many independent groups (e.g. image x class) in one call
+
+    Arguments
+    ---------
+    boxes : tensor (2D)
+        [x1, y1, x2, y2] for every candidate box
+
+    scores : tensor (1D)
+        score used to rank the boxes
+
+    groups : tensor (1D)
+        integer id per box, boxes only suppress boxes of the same group
+
+    nms_conf : float
+        boxes with an IoU >= nms_conf to a kept box of their group are dropped
+
+    Returns
+    -------
+    keep : tensor (1D)
+        indices of the kept boxes, ordered by group and then by descending score
+    """
+    order = group_order(scores, groups)
+    if order.numel() == 0:
+        return order
+
+    #Only pairs from the same group that overlap enough can suppress, and
+    #the one ranked higher is the suppressor
+    pairs = overlapping_pairs(boxes[order], groups[order], nms_conf)
+    return order[greedy_keep(pairs, order.size(0))]
+
+def write_results_batched(prediction, confidence, num_classes, nms=True, nms_conf=0.5):
+    """
+    Vectorised `write_results`: confidence filtering, centre to corner 
+    conversion and class-wise NMS for every image of the batch at once
+
+    Arguments
+    ---------
+    prediction : tensor (3D)
+        [centre_x, centre_y, box_width, box_height, objectness, class_confidence...]
+
+    Returns
+    -------
+    output : tensor (2D) or 0 if nothing is detected
+        [batch_index, x1, y1, x2, y2, objectness, class_confidence, class_index]
+    """
+    ind_nz = torch.nonzero(prediction[:,:,4] > confidence)
+    if ind_nz.size(0) == 0:
+        return 0
+
+    image_pred = prediction[ind_nz[:,0], ind_nz[:,1]]
+    return nms_detections(ind_nz[:,0], image_pred, num_classes, nms, nms_conf)
+
+def write_results_sparse(detections, num_classes, nms=True, nms_conf=0.5):
+    """
+    `write_results_batched` for the already filtered detections of 
+    `Darknet.forward(x, confidence=confidence)`
+
+    Arguments
+    ---------
+    detections : tensor (2D)
+        [batch_index, centre_x, centre_y, box_width, box_height, objectness, class_confidence...]
+
+    Returns
+    -------
+    output : tensor (2D) or 0 if nothing is detected
+        [batch_index, x1, y1, x2, y2, objectness, class_confidence, class_index]
+    """
+    if type(detections) == int or detections.size(0) == 0:
+        return 0
+
+    return nms_detections(detections[:,0].long(), detections[:,1:], num_classes, nms, nms_conf)
+
+def weighted_box_fusion(output, iou_thresh=0.5, num_views=1):
+    """
+    Fuses the overlapping detections of an image and class (e.g. from 
+    several test-time augmented views) into one box, the objectness 
+    weighted average of the cluster
+    
+    The clusters are those of greedy NMS: every box joins the highest 
+    ranked box kept by `batched_nms` of its image and class that it overlaps
+    by iou_thresh or more. Like in WBF, scores are averaged over the cluster
+    and scaled by min(cluster size, num_views) / num_views, so boxes only 
+    few views agree on lose confidence
+
+    Arguments
+    ---------
+    output : tensor (2D)
+        [batch_index, x1, y1, x2, y2, objectness, class_confidence, class_index]
+        as from `write_results_batched(..., nms=False)`
+
+    Returns
+    -------
+    output : tensor (2D) or 0 if there is nothing to fuse
+        same columns, one row per cluster ordered by image, class and score
+    """
+    if type(output) == int or output.size(0) == 0:
+        return 0
+
+    groups = torch.unique(output[:,[0,7]], dim=0, return_inverse=True)[1]
+    order = group_order(output[:,5], groups)
+    output = output[order]
+
+    pairs = overlapping_pairs(output[:,1:5], groups[order], iou_thresh)
+    keep = greedy_keep(pairs, output.size(0))
+
+    #Leaders are ordered by group and score, the first one a box overlaps 
+    #enough is the one greedy NMS would have suppressed it with
+    leader = torch.cumsum(keep, 0) - 1
+    pairs = pairs[keep[pairs[:,0]]]
+    cluster = torch.where(keep, leader, torch.full_like(leader, int(keep.sum())))
+    cluster.scatter_reduce_(0, pairs[:,1], leader[pairs[:,0]], reduce="amin")
+    keep = torch.nonzero(keep).squeeze(1)
+
+    weights = output[:,5]
+    total = output.new_zeros(keep.size(0)).index_add_(0, cluster, weights)
+    count = output.new_zeros(keep.size(0)).index_add_(0, cluster, torch.ones_like(weights))
+    agreement = torch.clamp(count, max=num_views) / num_views
+
+    fused = output[keep].clone()
+    fused[:,1:5] = output.new_zeros(keep.size(0), 4).index_add_(0, cluster, output[:,1:5]*weights.unsqueeze(1))
+    fused[:,1:5] /= total.unsqueeze(1)
+    fused[:,5] = total / count * agreement
+    fused[:,6] = output.new_zeros(keep.size(0)).index_add_(0, cluster, output[:,6]) / count * agreement
+
+    return fused
+
+def split_detections(output, batch_size):
+    """
+    Demultiplexes the output of `write_results` back to the images of the batch
+
+    Returns
+    -------
+    detections : list
+        For every image, in batch order, its rows of output or None when
+        nothing was detected in it
+    """
+    if type(output) == int:
+        return [None]*batch_size
+
+    detections = []
+    for i in range(batch_size):
+        rows = output[output[:,0] == i]
+        detections.append(rows if rows.size(0) else None)
+    return detections
+
+def nms_detections(batch_inds, image_pred, num_classes, nms=True, nms_conf=0.5):
+    """
+    Centre to corner conversion and class-wise NMS of detections gathered
+    from a whole batch
+
+    Arguments
+    ---------
+    batch_inds : tensor (1D)
+        image of the batch every detection belongs to
+
+    image_pred : tensor (2D)
+        [centre_x, centre_y, box_width, box_height, objectness, class_confidence...]
+
+    Returns
+    -------
+    output : tensor (2D)
+        [batch_index, x1, y1, x2, y2, objectness, class_confidence, class_index]
+    """
+    max_conf, max_conf_score = torch.max(image_pred[:,5:5+num_classes], 1)
+
+    output = image_pred.new(image_pred.size(0), 8)
+    output[:,0] = batch_inds
+    output[:,1:3] = image_pred[:,0:2] - image_pred[:,2:4]/2
+    output[:,3:5] = image_pred[:,0:2] + image_pred[:,2:4]/2
+    output[:,5] = image_pred[:,4]
+    output[:,6] = max_conf
+    output[:,7] = max_conf_score
+
+    #NMS is done per image and per class, flatten both into one group id
+    groups = batch_inds*num_classes + max_conf_score
+    if nms:
+        keep = batched_nms(output[:,1:5], output[:,5], groups, nms_conf)
+    else:
+        keep = group_order(output[:,5], groups)
+
+    return output[keep]
+
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
@@ -367,8 +740,8 @@ def write_results_half(prediction, confidence, num_classes, nms = True, nms_conf
 
 
 def writer(x, results, classes, colors):
-    c1 = tuple(x[1:3].int())
-    c2 = tuple(x[3:5].int())
+    c1 = tuple(int(v) for v in x[1:3])
+    c2 = tuple(int(v) for v in x[3:5])
     img = results[int(x[0])]
     cls = int(x[-1])
     label = "{0}".format(classes[cls])
@@ -408,23 +781,25 @@ def de_letter_box(prediction, im_dim_list, inp_dim):
     scaling_factor = torch.min(inp_dim/im_dim_list,1)[0].view(-1,1)
     
     # scale xs and yx
-    print('prediction before scale ', prediction)
     # prediction[:,[1,3]] -= (inp_dim - scaling_factor*im_dim_list[:,0].view(-1,1))/2
     # prediction[:,[2,4]] -= (inp_dim - scaling_factor*im_dim_list[:,1].view(-1,1))/2
     prediction[:,1:5] /= scaling_factor
 
-    print('prediction before clamp ', prediction)
-
     # loop over batches, clamp to [min, max]
     for i in range(prediction.shape[0]):
         # take predictions for bounding boxes TODO: figure out if abs is needed
         prediction[i, [1,3]] = torch.clamp(input=torch.abs(prediction[i, [1,3]]), min=0.0, max=im_dim_list[i,0])
         prediction[i, [2,4]] = torch.clamp(input=torch.abs(prediction[i, [2,4]]),  min=0.0, max=im_dim_list[i,1])
-    print('prediction from de_letter_box ', prediction)
     return prediction
 
-def write_preds(prediction, batch_imlist, save_dir, classes, colors):
-    orig_ims = [cv2.imread(im) for im in batch_imlist]
+def write_preds(prediction, batch_imlist, save_dir, classes, colors, orig_ims=None):
+    """
+    Draws the detections on the images of the batch and writes them to 
+    save_dir. The images are read from disk unless their decoded 
+    originals are given (drawn on in place)
+    """
+    if orig_ims is None:
+        orig_ims = [cv2.imread(im) for im in batch_imlist]
     list(map(lambda x: writer(x, orig_ims, classes, colors), prediction))
     det_names = pd.Series(batch_imlist).apply(lambda x: "{}/det_{}".format(save_dir,x.split("/")[-1]))
     list(map(cv2.imwrite, det_names, orig_ims))
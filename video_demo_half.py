@@ -6,11 +6,12 @@ from torch.autograd import Variable
 import numpy as np
 import cv2 
 from util import *
-from darknet import Darknet
-from preprocess import prep_image, inp_to_image, letterbox_image
+from preprocess import inp_to_image
+from preprocess import prep_frame as prep_image
+from pipeline import frame_batches, scale_to_frame
+from resources import get_classes, get_palette, load_model
 import pandas as pd
 import random 
-import pickle as pkl
 import argparse
 
 
@@ -27,23 +28,9 @@ def get_test_input(input_dim, CUDA):
     
     return img_
 
-def prep_image(img, inp_dim):
-    """
-    Prepare image for inputting to the neural network. 
-    
-    Returns a Variable 
-    """
-
-    orig_im = img
-    dim = orig_im.shape[1], orig_im.shape[0]
-    img = (letterbox_image(orig_im, (inp_dim, inp_dim)))
-    img_ = img[:,:,::-1].transpose((2,0,1)).copy()
-    img_ = torch.from_numpy(img_).float().div(255.0).unsqueeze(0)
-    return img_, orig_im, dim
-
 def write(x, img):
-    c1 = tuple(x[1:3].int())
-    c2 = tuple(x[3:5].int())
+    c1 = tuple(int(v) for v in x[1:3])
+    c2 = tuple(int(v) for v in x[3:5])
     cls = int(x[-1])
     label = "{0}".format(classes[cls])
     color = random.choice(colors)
@@ -78,6 +65,10 @@ def arg_parse():
     parser.add_argument("--reso", dest = 'reso', help = 
                         "Input resolution of the network. Increase to increase accuracy. Decrease to increase speed",
                         default = "416", type = str)
+    parser.add_argument("--bs", dest = "bs", help = "Most frames per forward",
+                        default = 1, type = int)
+    parser.add_argument("--batch_wait", dest = "batch_wait", help = "Milliseconds to wait for a batch to fill",
+                        default = 50, type = float)
     return parser.parse_args()
 
 
@@ -96,8 +87,7 @@ if __name__ == '__main__':
     bbox_attrs = 5 + num_classes
     
     print("Loading network.....")
-    model = Darknet(args.cfgfile)
-    model.load_weights(args.weightsfile)
+    model = load_model(args.cfgfile, args.weightsfile)
     print("Network successfully loaded")
     
     model.net_info["height"] = args.reso
@@ -109,78 +99,51 @@ if __name__ == '__main__':
     if CUDA:
         model.cuda().half()
         
-    model(get_test_input(inp_dim, CUDA), CUDA)
+    model(get_test_input(inp_dim, CUDA))
 
     model.eval()
     
+    classes = get_classes('data/coco.names')
+    colors = get_palette()
+    
     videofile = 'video.avi'
     
     cap = cv2.VideoCapture(videofile)
     
     assert cap.isOpened(), 'Cannot capture source'
     
+    if CUDA:
+        write_results = write_results_half
+        predict_transform = predict_transform_half
+    
     frames = 0
     start = time.time()    
-    while cap.isOpened():
+    stop = False
+    # frames are run through the network in batches of up to --bs frames
+    for batch in frame_batches(cap, args.bs, args.batch_wait/1000):
+        img = torch.cat([prep_image(frame, inp_dim)[0] for frame in batch])
         
-        ret, frame = cap.read()
-        if ret:
-            
-
-            img, orig_im, dim = prep_image(frame, inp_dim)
-            
-            im_dim = torch.FloatTensor(dim).repeat(1,2)                        
-            
-            
-            if CUDA:
-                img = img.cuda().half()
-                im_dim = im_dim.half().cuda()
-                write_results = write_results_half
-                predict_transform = predict_transform_half
-            
-            
-            output = model(Variable(img, volatile = True), CUDA)
-            output = write_results(output, confidence, num_classes, nms = True, nms_conf = nms_thesh)
-
-           
-            if type(output) == int:
-                frames += 1
-                print("FPS of the video is {:5.2f}".format( frames / (time.time() - start)))
-                cv2.imshow("frame", orig_im)
-                key = cv2.waitKey(1)
-                if key & 0xFF == ord('q'):
-                    break
-                continue
-
+        if CUDA:
+            img = img.cuda().half()
         
-            im_dim = im_dim.repeat(output.size(0), 1)
-            scaling_factor = torch.min(inp_dim/im_dim,1)[0].view(-1,1)
-            
-            output[:,[1,3]] -= (inp_dim - scaling_factor*im_dim[:,0].view(-1,1))/2
-            output[:,[2,4]] -= (inp_dim - scaling_factor*im_dim[:,1].view(-1,1))/2
-            
-            output[:,1:5] /= scaling_factor
-    
-            for i in range(output.shape[0]):
-                output[i, [1,3]] = torch.clamp(output[i, [1,3]], 0.0, im_dim[i,0])
-                output[i, [2,4]] = torch.clamp(output[i, [2,4]], 0.0, im_dim[i,1])
-            
-            
-            classes = load_classes('data/coco.names')
-            colors = pkl.load(open("pallete", "rb"))
-            
-            list(map(lambda x: write(x, orig_im), output))
-            
+        output = model(Variable(img, volatile = True))
+        output = write_results(output, confidence, num_classes, nms = True, nms_conf = nms_thesh)
+        
+        # back to one frame at a time, in capture order
+        for orig_im, detections in zip(batch, split_detections(output, len(batch))):
+            if detections is not None:
+                detections = scale_to_frame(detections, (orig_im.shape[1], orig_im.shape[0]), inp_dim)
+                list(map(lambda x: write(x, orig_im), detections))
             
             cv2.imshow("frame", orig_im)
             key = cv2.waitKey(1)
             if key & 0xFF == ord('q'):
+                stop = True
                 break
             frames += 1
             print("FPS of the video is {:5.2f}".format( frames / (time.time() - start)))
-
-            
-        else:
+        
+        if stop:
             break
     
 